@@ -1,8 +1,13 @@
-from pyg_encoders._encode import encode, decode, dumps, loads, pd2bson, bson2pd, bson2np
+from pyg_encoders._encode import encode, decode, dumps, loads, pd2bson, bson2pd, bson2np, materialize, LazyValue, decode_many, Encoded, inline_payloads
 from pyg_encoders._dump import dump, load
-from pyg_encoders._encoders import cell_root, root_path, root_path_check, pd_to_csv, pd_read_csv, \
+from pyg_encoders._encoders import cell_root, root_path, root_paths, root_path_check, pd_to_csv, pd_read_csv, \
         pickle_dump, pickle_load, npy_encode, npy_write, parquet_encode, parquet_write, pickle_write, \
         pickle_encode, csv_encode, csv_write, encode, dictable_decode, dictable_decoded
-from pyg_encoders._writers import as_reader, as_writer, WRITERS, READERS, pd_read_root
-from pyg_encoders._parquet import pd_read_parquet, pd_to_parquet
-from pyg_encoders._threads import executor_pool
+from pyg_encoders._writers import as_reader, as_writer, WRITERS, READERS, pd_read_root, pd_read_roots, rebuild_manifest
+from pyg_encoders._manifest import read_manifest, write_manifest, remove_manifest
+from pyg_encoders._parquet import pd_read_parquet, pd_to_parquet, pd_iter_parquet, compact, dictable_to_parquet, dictable_read_parquet
+from pyg_encoders._threads import executor_pool, submit_write, pending, flush, write_barrier, write_stats, WriteError
+from pyg_encoders._locks import file_locking, atomic_writes
+from pyg_encoders._cache import decode_cache, cache_stats
+from pyg_encoders._fingerprint import content_hash
+from pyg_encoders._cas import cas_encode, cas_write, cas_gc
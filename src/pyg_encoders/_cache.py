@@ -0,0 +1,219 @@
+import threading
+import functools
+import inspect
+import sys
+import os
+from collections import OrderedDict
+from pyg_base import is_pd, is_arr
+
+# -*- coding: utf-8 -*-
+
+_SETTINGS = dict(enabled = False, max_bytes = 2**30)
+_CACHE = OrderedDict() # key -> (stamp, value, nbytes), least recently used first
+_PATHS = {} # path -> set of keys read from path
+_STATS = dict(hits = 0, misses = 0, evictions = 0, invalidations = 0, bytes = 0)
+_CACHE_LOCK = threading.Lock()
+_VERSIONS = [0] * 4096 # striped by path, bumped on invalidation so a read that straddles a write is not cached
+_deltas = '.deltas'
+_parts = '.parts'
+_npy_exts = ('.npy', '.npa')
+
+
+def decode_cache(enabled = True, max_bytes = None):
+    """
+    Decoding a document such as {_obj: _pd_read_parquet, path: ...} reads the file from disk every time.
+    In a dependency graph the same upstream DataFrame may be decoded hundreds of times per run.
+
+    When enabled, the file readers behind _pd_read_parquet, _pd_read_csv, _pd_read_npy, _pickle_load and _np_load
+    keep what they read in a single LRU cache, bounded by the total bytes of the cached values.
+
+    - a cached value is only returned if the (mtime, size) of its files are unchanged, so writes by other processes are picked up.
+    - our own writers in _locks.py drop the entries of the paths they write to.
+
+    Values are shared by all callers: pandas objects are returned as shallow copies but arrays are returned as is and should be treated as read only.
+
+    :Parameters:
+    ------------
+    enabled: bool
+        switch the cache on/off. Switching it off empties it.
+    max_bytes: int
+        the budget of the cache. Least recently used values are evicted beyond it.
+
+    :Returns:
+    ---------
+    dict of the current settings
+
+    :Example:
+    ---------
+    >>> from pyg import *
+    >>> value = pd.DataFrame(np.random.normal(0,1,(100000,26)), columns = list(ALPHABET), index = drange(-99999))
+    >>> doc = parquet_encode(value, 'c:/temp/cached.parquet', max_workers = 0)
+    >>> uncached_time = timer(decode, n = 100, time = True)(doc)
+    >>> decode_cache(True, max_bytes = 500e6)
+    >>> cached_time = timer(decode, n = 100, time = True)(doc)
+    >>> assert uncached_time > 50 * cached_time ## ~230ms to read the file vs ~3ms to check its stamp
+    >>> cache_stats()
+    {'hits': 99, 'misses': 1, 'evictions': 0, 'invalidations': 0, 'bytes': 21600000, 'entries': 1, 'max_bytes': 500000000.0}
+    >>> doc = parquet_encode(value + 1, 'c:/temp/cached.parquet', max_workers = 0) ## the writer drops the cached value
+    >>> assert eq(decode(doc), value + 1)
+    """
+    with _CACHE_LOCK:
+        _SETTINGS['enabled'] = enabled
+        if max_bytes is not None:
+            _SETTINGS['max_bytes'] = max_bytes
+        if not enabled:
+            _CACHE.clear()
+            _PATHS.clear()
+            _STATS['bytes'] = 0
+        _evict()
+        return dict(_SETTINGS)
+
+
+def cache_stats(reset = False):
+    """
+    returns the hits, misses, evictions and invalidations of the decode cache, together with the bytes and number of entries it holds.
+
+    :Parameters:
+    ------------
+    reset: bool
+        if True, the counters are set back to zero
+    """
+    with _CACHE_LOCK:
+        res = dict(_STATS)
+        res.update(entries = len(_CACHE), max_bytes = _SETTINGS['max_bytes'])
+        if reset:
+            _STATS.update(hits = 0, misses = 0, evictions = 0, invalidations = 0)
+    return res
+
+
+def _norm(path):
+    path = os.path.normpath(str(path).split('@')[0])
+    for ext in _npy_exts:
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    return path
+
+
+def _files(path):
+    """
+    the files whose (mtime, size) determine if what we read from path is still valid
+    """
+    path = str(path).split('@')[0]
+    if os.path.isfile(path):
+        return [path, path + _deltas, path + _parts]
+    path = _norm(path)
+    return [os.path.join(path, fname) for fname in ('data.npy', 'index.npy', 'metadata.json')]
+
+
+def _stamp(path):
+    res = []
+    for fname in _files(path):
+        try:
+            s = os.stat(fname)
+            res.append((s.st_mtime_ns, s.st_size))
+        except OSError:
+            res.append(None)
+    return tuple(res)
+
+
+def _sizeof(value):
+    if is_pd(value):
+        n = value.memory_usage(index = True, deep = False)
+        return int(n if isinstance(n, int) else n.sum())
+    elif is_arr(value):
+        return value.nbytes
+    else:
+        return sys.getsizeof(value)
+
+
+def _hashable(value):
+    if isinstance(value, (list, tuple)):
+        return tuple([_hashable(v) for v in value])
+    elif isinstance(value, dict):
+        return tuple(sorted([(k, _hashable(v)) for k, v in value.items()]))
+    return value
+
+
+def _shallow(value):
+    return value.copy(deep = False) if is_pd(value) else value
+
+
+def _evict():
+    while len(_CACHE) and _STATS['bytes'] > _SETTINGS['max_bytes']:
+        key, (stamp, value, nbytes) = _CACHE.popitem(last = False)
+        _drop(key, nbytes)
+        _STATS['evictions'] += 1
+
+
+def _drop(key, nbytes):
+    _STATS['bytes'] -= nbytes
+    keys = _PATHS.get(key[1])
+    if keys is not None:
+        keys.discard(key)
+        if len(keys) == 0:
+            del _PATHS[key[1]]
+
+
+def invalidate(path):
+    """
+    drops the cached values read from path. Called by our writers once they have written to path.
+    """
+    path = _norm(path)
+    paths = [path]
+    parent = os.path.dirname(path)
+    for ext in (_deltas, _parts): ## a bitemporal delta or an appended part file changes what we read from its parent
+        if parent.endswith(ext):
+            paths.append(parent[:-len(ext)])
+    with _CACHE_LOCK:
+        for p in paths:
+            _VERSIONS[hash(p) % len(_VERSIONS)] += 1
+            for key in list(_PATHS.get(p, [])):
+                nbytes = _CACHE.pop(key)[2]
+                _drop(key, nbytes)
+                _STATS['invalidations'] += 1
+
+
+def cached(func):
+    """
+    decorates a file reader func(path, ...) so that, when decode_cache is enabled, what it reads is kept in the decode cache.
+    The cache key is the path together with all the other arguments.
+    """
+    name = '%s.%s'%(func.__module__, func.__qualname__)
+    arg = list(inspect.signature(func).parameters)[0]
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _SETTINGS['enabled']:
+            return func(*args, **kwargs)
+        path = args[0] if len(args) else kwargs.get(arg)
+        if not isinstance(path, str):
+            return func(*args, **kwargs)
+        key = (name, _norm(path), _hashable(args), _hashable(kwargs))
+        try:
+            hash(key)
+        except TypeError:
+            return func(*args, **kwargs)
+        stamp = _stamp(path)
+        with _CACHE_LOCK:
+            hit = _CACHE.get(key)
+            if hit is not None and hit[0] == stamp:
+                _CACHE.move_to_end(key)
+                _STATS['hits'] += 1
+                return _shallow(hit[1])
+            _STATS['misses'] += 1
+            version = _VERSIONS[hash(key[1]) % len(_VERSIONS)]
+        value = func(*args, **kwargs)
+        if stamp == tuple([None] * len(stamp)) or stamp != _stamp(path): ## nothing on disk or it changed while we read it
+            return value
+        nbytes = _sizeof(value)
+        with _CACHE_LOCK:
+            if version != _VERSIONS[hash(key[1]) % len(_VERSIONS)] or nbytes > _SETTINGS['max_bytes'] or not _SETTINGS['enabled']:
+                return value
+            if key in _CACHE:
+                _drop(key, _CACHE.pop(key)[2])
+            _CACHE[key] = (stamp, value, nbytes)
+            _PATHS.setdefault(key[1], set()).add(key)
+            _STATS['bytes'] += nbytes
+            _evict()
+        return _shallow(value)
+    return wrapper
@@ -0,0 +1,189 @@
+import os
+import re
+import time
+from pyg_base import is_pd, is_arr, is_dict, dictable
+from pyg_encoders._encode import Encoded, encode, _obj
+from pyg_encoders._encoders import cell_root, root_path, root_path_check, _pd_read_parquet, _np_load, _dictable_decode, _np_save, _parquet, _npy
+from pyg_encoders._parquet import pd_to_parquet
+from pyg_encoders._fingerprint import content_hash
+from pyg_encoders._threads import pending
+
+__all__ = ['cas_encode', 'cas_write', 'cas_gc']
+
+_cas = '.cas'
+_blob = re.compile(r'^[0-9a-f]{32}(\.parquet|\.npy)$')
+
+
+def cas_path(root, fingerprint, ext = _parquet):
+    """
+    the location of a blob within a content addressed store, sharded by the first two bytes of its hash, e.g. c:/store/ab/cd/abcd....parquet
+    """
+    return '%s/%s/%s/%s%s'%(root, fingerprint[:2], fingerprint[2:4], fingerprint, ext)
+
+
+def _stored(path):
+    """
+    True if the blob is already stored (or queued to be stored). We touch it so cas_gc will not collect a blob we have just referenced
+    """
+    if os.path.exists(path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return True
+    return path in pending()
+
+
+def cas_encode(value, root, max_workers = 4, pool_name = None):
+    """
+    encodes a DataFrame or a document containing DataFrames and arrays into a content addressed store at root.
+    Each DataFrame/array is stored once under its content_hash, so identical values referenced by many documents share a single file,
+    and writing a value that is already stored costs only the hash.
+
+    :Example:
+    ---------
+    >>> from pyg import *
+    >>> a = pd.DataFrame(dict(a = [1,2,3], b= [4,5,6]), index = drange(2))
+    >>> encoded = cas_encode(dict(x = a, y = a.copy(), n = np.arange(3)), 'c:/store')
+    >>> assert encoded['x']['path'] == encoded['y']['path'] == cas_path('c:/store', content_hash(a))
+    >>> assert eq(decode(encoded)['y'], a)
+
+    :Parameters:
+    ------------
+    value: document
+        value to be encoded
+    root: str
+        the root directory of the store. Blobs are written to root/<hash[:2]>/<hash[2:4]>/<hash>.parquet or .npy for arrays
+
+    :Returns:
+    ---------
+    the document, with DataFrames and arrays replaced by references to their blobs
+    """
+    if root.endswith(_cas):
+        root = root[:-len(_cas)]
+    root = root.rstrip('/')
+    if is_pd(value):
+        fingerprint = content_hash(value)
+        path = cas_path(root_path_check(root), fingerprint)
+        if not _stored(path):
+            pd_to_parquet(value, path, max_workers = max_workers, pool_name = pool_name)
+        return Encoded(_obj = _pd_read_parquet, path = path, fingerprint = fingerprint)
+    elif is_arr(value):
+        fingerprint = content_hash(value)
+        path = cas_path(root_path_check(root), fingerprint, _npy)
+        if not _stored(path):
+            _np_save(path, value, max_workers = max_workers, pool_name = pool_name)
+        return Encoded(_obj = _np_load, file = path)
+    elif is_dict(value):
+        res = type(value)(**{k : cas_encode(v, root, max_workers = max_workers, pool_name = pool_name) for k, v in value.items()})
+        if isinstance(value, dictable): ## we keep the cells in the document rather than in a blob, so that cas_gc can see the references
+            return Encoded(_obj = _dictable_decode, df = encode(dict(res)))
+        return res
+    elif isinstance(value, (list, tuple)):
+        return type(value)([cas_encode(v, root, max_workers = max_workers, pool_name = pool_name) for v in value])
+    else:
+        return value
+
+
+def cas_write(doc, root = None, asof = None, max_workers = 4, pool_name = None):
+    """
+    writes the DataFrames and arrays in a document into a content addressed store, see cas_encode.
+    Unlike parquet_write, the location is not unique per document: root may still use keys of the document (e.g. 'c:/store/%market.cas') to keep separate stores.
+    Blobs are immutable and shared, so asof is ignored: bitemporal DataFrames are stored as given.
+
+    >>> from pyg import *
+    >>> db = partial(mongo_table, db = 'temp', table = 'temp', pk = 'key', writer = 'c:/store.cas')
+
+    Blobs no longer referenced by any document are removed by cas_gc.
+    """
+    root = cell_root(doc, root)
+    if root is None:
+        return doc
+    return cas_encode(doc, root_path(doc, root), max_workers = max_workers, pool_name = pool_name)
+
+
+def _refs(value, res = None):
+    """
+    collects the files referenced by an encoded document
+    """
+    res = set() if res is None else res
+    if isinstance(value, dict):
+        if _obj in value:
+            for key in ('path', 'file'):
+                if isinstance(value.get(key), str):
+                    res.add(os.path.normpath(value[key]))
+        for v in value.values():
+            _refs(v, res)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _refs(v, res)
+    return res
+
+
+def cas_blobs(root):
+    """
+    yields the blobs stored in the content addressed store at root
+    """
+    if root.endswith(_cas):
+        root = root[:-len(_cas)]
+    if not os.path.isdir(root):
+        return
+    for a in os.scandir(root):
+        if a.is_dir() and len(a.name) == 2:
+            for b in os.scandir(a.path):
+                if b.is_dir() and len(b.name) == 2:
+                    for c in os.scandir(b.path):
+                        if c.is_file() and _blob.match(c.name):
+                            yield c.path
+
+
+def cas_gc(root, docs, min_age = 3600, dry_run = False):
+    """
+    removes the blobs in the content addressed store at root that none of the live documents reference.
+
+    :Example:
+    ---------
+    >>> from pyg import *
+    >>> a = pd.DataFrame(dict(a = [1,2,3]), index = drange(2)); b = a + 1
+    >>> live = cas_write(dict(key = 'x', data = a), 'c:/store.cas')
+    >>> dead = cas_write(dict(key = 'y', data = b), 'c:/store.cas')
+    >>> flush()
+    >>> assert cas_gc('c:/store', [live], min_age = 0) == [dead['data']['path']]
+
+    :Parameters:
+    ------------
+    root: str
+        the root directory of the store
+    docs: list of documents
+        the live documents, as returned by cas_write (i.e. encoded), e.g. everything in a mongo table whose writer is root.cas
+    min_age: float
+        blobs modified within the last min_age seconds are kept.
+        A writer referencing an existing blob touches it, so this protects blobs referenced by documents written while we collect.
+    dry_run: bool
+        if True, we only return the blobs that would be removed
+
+    :Returns:
+    ---------
+    list of the blobs removed
+    """
+    if is_dict(docs):
+        docs = [docs]
+    live = set()
+    for doc in docs:
+        _refs(doc, live)
+    busy = set(os.path.normpath(path) for path in pending())
+    cutoff = time.time() - min_age
+    res = []
+    for path in cas_blobs(root):
+        fname = os.path.normpath(path)
+        if fname in live or fname in busy:
+            continue
+        try:
+            if os.path.getmtime(path) > cutoff:
+                continue
+            if not dry_run:
+                os.remove(path)
+        except FileNotFoundError:
+            continue
+        res.append(path)
+    return res
@@ -0,0 +1,118 @@
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+from pyg_base import is_series, is_df, is_arr
+from pyg_encoders._locks import _LOCKS, _json_dumps, _locked_json_load
+from pyg_encoders._threads import _is_pending
+
+__all__ = ['content_hash']
+
+_fingerprint = '.fingerprint'
+
+
+def _update_array(h, value):
+    value = np.asarray(value)
+    h.update(('%s%s'%(value.dtype, value.shape)).encode())
+    if value.dtype == object:
+        try:
+            h.update(pd.util.hash_array(value.ravel()).tobytes())
+        except TypeError: # unhashable objects such as lists
+            h.update(repr(value.tolist()).encode())
+    else:
+        h.update(np.ascontiguousarray(value).tobytes())
+
+
+def _update_index(h, index):
+    h.update(repr(list(index.names)).encode())
+    for i in range(index.nlevels):
+        _update_array(h, index.get_level_values(i))
+
+
+def content_hash(value):
+    """
+    a fast fingerprint of a DataFrame, Series or array: a 128 bit blake2b hash over the numpy buffers of the values, index and columns.
+    Two values with the same content, dtypes, index and columns have the same hash.
+
+    :Example:
+    ---------
+    >>> from pyg import *
+    >>> value = pd.DataFrame(np.random.normal(0,1,(1000000,10)), pd.date_range(dt(2000), periods = 1000000, freq = 'min'))
+    >>> assert content_hash(value) == content_hash(value.copy()) != content_hash(value + 1)
+    >>> timer(content_hash)(value) ## ~0.2s for 80MB, vs ~12s to write it to a GZIP parquet file
+    """
+    h = hashlib.blake2b(digest_size = 16)
+    if is_series(value):
+        h.update(('series%r'%(value.name,)).encode())
+        _update_index(h, value.index)
+        _update_array(h, value.values)
+    elif is_df(value):
+        h.update(b'df')
+        _update_index(h, value.columns)
+        _update_index(h, value.index)
+        dtypes = set(value.dtypes)
+        if len(dtypes) == 1 and np.dtype(object) not in dtypes and isinstance(list(dtypes)[0], np.dtype):
+            _update_array(h, value.values)
+        else:
+            for i in range(value.shape[1]):
+                _update_array(h, value.iloc[:, i].values)
+    elif is_arr(value):
+        _update_array(h, value)
+    else:
+        raise TypeError('cannot fingerprint a %s'%type(value))
+    return h.hexdigest()
+
+
+def _fingerprint_path(path):
+    return path + _fingerprint
+
+
+def _stamp(target):
+    """
+    identifies the file written: any later write, fingerprinted or not, replaces it with a file of a different inode/mtime
+    """
+    stat = os.stat(target)
+    return [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+
+
+def unchanged(path, fingerprint, target = None, others = ()):
+    """
+    True if the file (or npy directory) at target exists and its last write was of a value with this fingerprint.
+    others are files that also change what we read from path, e.g. bitemporal deltas. If any exist, path is not unchanged.
+    """
+    target = path if target is None else target
+    if not os.path.exists(target) or max([os.path.exists(other) for other in others], default = False):
+        return False
+    try:
+        return _locked_json_load(_fingerprint_path(path), atomic = True) == [fingerprint, _stamp(target)]
+    except (OSError, ValueError):
+        return False
+
+
+def skip_write(path, fingerprint, target = None, others = ()):
+    """
+    True if we can skip writing a value with this fingerprint to path without submitting it. 
+    A queued write to path may change the file after we look, so we only skip if none is pending, see fingerprinted.
+    """
+    return not _is_pending(path) and unchanged(path, fingerprint, target, others)
+
+
+def fingerprinted(func, path, fingerprint, *args, target = None, others = ()):
+    """
+    calls func(*args) to write path and then records the fingerprint alongside it.
+    We compare the fingerprint here, in the writer and under the lock of path, so writes queued before us are taken into account:
+    writing a, b and then a again must leave a on disk.
+    The old fingerprint is removed first so that if the write fails, we do not skip the next write.
+    """
+    target = path if target is None else target
+    fname = _fingerprint_path(path)
+    with _LOCKS.write(path):
+        if unchanged(path, fingerprint, target, others):
+            return path
+        try:
+            os.remove(fname)
+        except FileNotFoundError:
+            pass
+        res = func(*args)
+        _json_dumps([fingerprint, _stamp(target)], fname, atomic = True) ## we already hold the lock of path, see _to_parquet
+    return res
@@ -0,0 +1,117 @@
+import os
+import time
+from pyg_base import is_pd, is_df, is_arr, is_dict, dictable
+from pyg_base._bitemporal import _updated
+from pyg_encoders._encode import encode, _dumps, _obj
+from pyg_encoders._locks import _locked_json_dumps, _locked_json_load
+
+__all__ = ['read_manifest', 'write_manifest', 'remove_manifest']
+
+_manifest = '_manifest.json'
+_exts = ('.parquet', '.npy', '.npa', '.pickle', '.csv')
+
+
+def manifest_path(path):
+    """
+    the manifest of the document written to path, e.g. c:/archive/uk/london/results.parquet -> c:/archive/uk/london/results/_manifest.json
+    """
+    path = path.split('@')[0]
+    for ext in _exts:
+        if path.endswith(ext):
+            path = path[:-len(ext)]
+            break
+    return os.path.join(path.rstrip('/\\'), _manifest)
+
+
+def _files(value, encoded):
+    """
+    walks the encoded document together with the value it was encoded from, yielding the files referenced
+    """
+    if isinstance(encoded, dict) and _obj in encoded and ('path' in encoded or 'file' in encoded):
+        path = encoded.get('path', encoded.get('file'))
+        res = dict(path = path, format = os.path.splitext(path)[1] or '.npy', shape = list(value.shape) if is_pd(value) or is_arr(value) else None, asof = None)
+        if is_df(value) and _updated in value.columns and len(value):
+            res['asof'] = [value[_updated].min(), value[_updated].max()]
+        yield res
+    elif isinstance(encoded, dict):
+        for k, v in encoded.items():
+            if k != _obj:
+                yield from _files(value.get(k) if is_dict(value) and not isinstance(value, dictable) else None, v)
+    elif isinstance(encoded, (list, tuple)):
+        values = value if isinstance(value, (list, tuple)) and len(value) == len(encoded) else [None] * len(encoded)
+        for v, e in zip(values, encoded):
+            yield from _files(v, e)
+
+
+def _ref(encoded):
+    """
+    the reference we keep in the manifest. Bitemporal files are referenced without the asof they were written with,
+    so that pd_read_root returns the whole bitemporal DataFrame whether it reads the manifest or lists the directory.
+    """
+    if isinstance(encoded, dict) and _obj in encoded and ('path' in encoded or 'file' in encoded):
+        return type(encoded)({k : v for k, v in encoded.items() if k != 'asof'})
+    elif isinstance(encoded, dict):
+        return type(encoded)({k : _ref(v) for k, v in encoded.items()})
+    elif isinstance(encoded, (list, tuple)):
+        return type(encoded)([_ref(v) for v in encoded])
+    return encoded
+
+
+def write_manifest(path, doc, encoded):
+    """
+    writes a manifest of the files that the encoded document references into the document's directory.
+    For each key of the document that is stored in files, we keep the reference to decode and, per file, its path, format, shape, the time written and the asof range of bitemporal data.
+    pd_read_root reads the manifest rather than probing the directory for each output.
+
+    :Parameters:
+    ------------
+    path: str
+        the location the document was encoded to, e.g. root_path(doc, root)
+    doc: dict
+        the document before encoding
+    encoded: dict
+        the document returned by parquet_encode/npy_encode/pickle_encode/csv_encode
+
+    :Returns:
+    ---------
+    path of the manifest, or None if the document is not stored per key
+    """
+    if not isinstance(encoded, dict) or _obj in encoded: ## the whole document is stored in a single file, e.g. by pickle_encode
+        remove_manifest(path)
+        return None
+    now = time.time()
+    manifest = {}
+    for key, value in encoded.items():
+        files = list(_files(doc.get(key), value))
+        if len(files):
+            for f in files:
+                f['mtime'] = now
+            manifest[key] = dict(ref = _ref(value), files = files)
+    return _write_manifest(manifest_path(path), manifest)
+
+
+def _write_manifest(fname, manifest):
+    if not os.path.isdir(os.path.dirname(fname)):
+        os.makedirs(os.path.dirname(fname))
+    return _locked_json_dumps(_dumps(encode(manifest)), fname)
+
+
+def remove_manifest(path):
+    """
+    removes the manifest of the document written to path, if any. 
+    Writers call this when they do not write a manifest: one left by an earlier write would no longer list what is on disk and pd_read_root would trust it.
+    """
+    try:
+        os.remove(manifest_path(path))
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+
+
+def read_manifest(path):
+    """
+    returns the manifest written by write_manifest into the directory path, or None if there is none
+    """
+    try:
+        return _locked_json_load(os.path.join(path, _manifest))
+    except (OSError, ValueError):
+        return None
@@ -1,14 +1,531 @@
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait
+from pyg_base._logger import logger
+from pyg_base._types import is_pd, is_df, is_arr, is_str
+import threading
 
 executors = {}
 
-def executor_pool(max_workers = 4, name = None):
+_PENDING = {} # path -> list of (pool_name, future) submitted but not yet completed
+_FAILED = {} # (pool_name, path) -> exception raised by the last failed write to path
+_STATS = {} # (max_workers, pool_name) -> dict of counters
+_LIMITS = {} # (max_workers, pool_name) -> dict(max_pending, max_bytes, when_full)
+_KINDS = {} # (max_workers, pool_name) -> 'thread' or 'process'
+_PENDING_LOCK = threading.Lock()
+_PENDING_DONE = threading.Condition(_PENDING_LOCK)
+
+__all__ = ['executor_pool', 'submit_write', 'pending', 'flush', 'write_barrier', 'write_stats', 'WriteError']
+
+
+class WriteError(Exception):
+    """
+    raised by flush when one or more of the asynchronous writes failed.
+    errors is a dict of path to the exception raised while writing to that path
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        msg = '%i asynchronous write(s) failed:\n%s'%(len(errors), '\n'.join('%s: %r'%(path, e) for path, e in errors.items()))
+        super(WriteError, self).__init__(msg)
+
+
+def executor_pool(max_workers = 4, name = None, max_pending = None, max_bytes = None, when_full = None, kind = None):
     """
     we want to have a pool of threads that we don't need to recreate all the times.
     We will use these to write to files rather than use the main threads
+
+    Compressing parquet files and pickling are CPU bound and under threads, they compete for the GIL with the main thread.
+    A pool created with kind = 'process' runs the writes in worker processes instead:
+    
+    - DataFrames are shipped to the workers as Arrow IPC streams in shared memory rather than pickled through a pipe
+    - writes to the same path are dispatched one after the other so two workers never write to the same file at once
+    
+    The kind of the pool is determined when it is first created.
+    
+    ThreadPoolExecutor has an unbounded queue and each job holds a reference to the DataFrame it writes. 
+    If we produce data faster than the disk can write, memory grows without limit. 
+    We can bound the pool by the number of jobs and/or by the (estimated) bytes of the values held by jobs that have not completed yet.
+    The limits are set once per pool and apply to all writes submitted via submit_write to it.
+
+    :Parameters:
+    ------------
+    max_workers: int
+        number of threads
+    name: str
+        name of the pool
+    max_pending: int
+        maximum number of writes in flight
+    max_bytes: int
+        maximum number of bytes held by writes in flight, estimated using DataFrame.memory_usage
+    when_full: str
+        'block': wait for writes to complete before submitting (default)
+        'sync': write synchronously in the calling thread, unless earlier writes to the same path are still queued, in which case we wait
+    kind: str
+        'thread' (default) or 'process'
+
+    :Example: bounding memory
+    ---------
+    >>> from pyg import *
+    >>> value = pd.DataFrame(np.random.normal(0,1,(10000,26)), columns = list(ALPHABET), index = drange(-9999))
+    >>> pool = executor_pool(4, 'bounded', max_bytes = 10 * value.memory_usage().sum())
+    >>> for i in range(100):
+    >>>     pd_to_parquet(value, 'c:/temp/bounded/%i.parquet'%i, max_workers = 4, pool_name = 'bounded')
+    >>> assert write_stats('bounded')['high_water_bytes'] <= 10 * value.memory_usage().sum()
+
+    :Example: threads vs processes
+    ---------
+    >>> from pyg import *
+    >>> value = pd.DataFrame(np.random.normal(0,1,(10000,26)), columns = list(ALPHABET), index = drange(-9999))
+    >>> path = 'c:/temp/test_%s.parquet'
+    >>> pool = executor_pool(4, 'process', kind = 'process')
+    >>> def write(pool_name, n = 100):
+    >>>     for i in range(n):
+    >>>         pd_to_parquet(value, path%i, max_workers = 4, pool_name = pool_name)
+    >>>     flush(pool_name)
+    >>> threading_time = timer(write, time = True)(None)
+    >>> process_time = timer(write, time = True)('process')
+    >>> blocking_time = timer(pd_to_parquet, n = 100, time = True)(value, path%'blocking', max_workers = 0)
+    >>> assert blocking_time > process_time ## on a 4+ core box, process_time is typically half of threading_time as GZIP no longer holds the GIL
     """
     key = (max_workers, name)
     if key not in executors:
-        executors[key] = ThreadPoolExecutor(max_workers=max_workers)
+        kind = kind or 'thread'
+        if kind == 'thread':
+            executors[key] = ThreadPoolExecutor(max_workers=max_workers)
+        elif kind == 'process':
+            executors[key] = ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            raise ValueError('kind must be "thread" or "process", not "%s"'%kind)
+        _KINDS[key] = kind
+    elif kind is not None and kind != _KINDS.get(key, 'thread'):
+        raise ValueError('pool %s already exists as a %s pool'%(key, _KINDS.get(key, 'thread')))
+    if max_pending is not None or max_bytes is not None or when_full is not None:
+        limits = _LIMITS.setdefault(key, dict(max_pending = None, max_bytes = None, when_full = 'block'))
+        if max_pending is not None:
+            limits['max_pending'] = max_pending
+        if max_bytes is not None:
+            limits['max_bytes'] = max_bytes
+        if when_full is not None:
+            if when_full not in ('block', 'sync'):
+                raise ValueError('when_full must be "block" or "sync", not "%s"'%when_full)
+            limits['when_full'] = when_full
     return executors[key]
 
+
+class _shared_df(object):
+    """
+    A DataFrame written into shared memory as an Arrow IPC stream. 
+    Only the name of the shared memory block is pickled so a worker process can map the data rather than receive it through a pipe.
+    """
+    def __init__(self, df):
+        import pyarrow as pa
+        from multiprocessing import shared_memory
+        table = pa.Table.from_pandas(df)
+        sink = pa.MockOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        self.size = sink.size()
+        self._shm = shared_memory.SharedMemory(create = True, size = max(self.size, 1))
+        self.name = self._shm.name
+        buf = pa.py_buffer(self._shm.buf)
+        stream = pa.FixedSizeBufferWriter(buf)
+        with pa.ipc.new_stream(stream, table.schema) as writer:
+            writer.write_table(table)
+        stream.close()
+        del writer, stream, buf ## release the exported memoryview so the block can be closed later
+
+    def __getstate__(self):
+        return dict(name = self.name, size = self.size)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shm = None
+
+    def load(self):
+        """
+        maps the shared memory block in the worker and returns the DataFrame. The block must be closed once the DataFrame is no longer used.
+        """
+        import pyarrow as pa
+        from multiprocessing import shared_memory
+        self._shm = shared_memory.SharedMemory(name = self.name) ## the block is owned, and unlinked, by the parent
+        with pa.ipc.open_stream(pa.py_buffer(self._shm.buf)[:self.size]) as reader:
+            return reader.read_pandas()
+
+    def close(self):
+        if self._shm is not None:
+            try:
+                self._shm.close()
+            except BufferError: ## the DataFrame is still referenced, the mapping is released once it is garbage collected
+                pass
+            self._shm = None
+
+    def unlink(self):
+        if self._shm is not None:
+            try:
+                self._shm.close()
+            except BufferError:
+                pass
+            self._shm.unlink()
+            self._shm = None
+
+
+def _as_shared(value):
+    """
+    DataFrames with string column names are shipped via shared memory. Everything else (Series, non-string columns) is pickled as usual.
+    Used only for writers that convert to Arrow anyway, see submit_write(shared = True).
+    """
+    if is_df(value) and min([is_str(col) for col in value.columns], default = False):
+        try:
+            return _shared_df(value)
+        except Exception:
+            pass
+    return value
+
+
+def _shared_call(func, *args):
+    shared = [arg for arg in args if isinstance(arg, _shared_df)]
+    args = [arg.load() if isinstance(arg, _shared_df) else arg for arg in args]
+    try:
+        return func(*args)
+    finally:
+        del args
+        for arg in shared:
+            arg.close()
+
+
+def _after(futures, callback):
+    """
+    calls callback() once all futures are done
+    """
+    if len(futures) == 0:
+        return callback()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            ready = remaining[0] == 0
+        if ready:
+            callback()
+    for f in futures:
+        f.add_done_callback(done)
+
+
+def _run(future, func, args):
+    """
+    runs func(*args) within a thread of the pool, unless the write was superseded while it was queued
+    """
+    if not future.set_running_or_notify_cancel():
+        return
+    try:
+        future.set_result(func(*args))
+    except BaseException as e:
+        future.set_exception(e)
+
+
+def _launch(pool, future, func, args, process = False, shared = False):
+    """
+    submits func(*args) to the pool once the earlier writes to the same path are done.
+    A process pool cannot mark our future as running, so we do so here and relay the outcome of the job into future.
+    If shared, DataFrames are shipped to the process via shared memory rather than pickled.
+    """
+    if not process:
+        try:
+            pool.submit(_run, future, func, args)
+        except Exception as e:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(e)
+        return
+    if not future.set_running_or_notify_cancel(): ## superseded while waiting for earlier writes to path
+        return
+    shared = [_as_shared(arg) for arg in args] if shared else list(args)
+    def release():
+        for arg in shared:
+            if isinstance(arg, _shared_df):
+                arg.unlink()
+    def relay(job):
+        release()
+        e = None if job.cancelled() else job.exception()
+        if job.cancelled():
+            future.set_exception(RuntimeError('process pool write was cancelled'))
+        elif e is not None:
+            future.set_exception(e)
+        else:
+            future.set_result(job.result())
+    try:
+        job = pool.submit(_shared_call, func, *shared)
+    except Exception as e:
+        release()
+        future.set_exception(e)
+        return
+    job.add_done_callback(relay)
+
+
+def _stats(key):
+    if key not in _STATS:
+        _STATS[key] = dict(submitted = 0, written = 0, failed = 0, dropped = 0, sync = 0, 
+                           queued = 0, queued_bytes = 0, high_water = 0, high_water_bytes = 0)
+    return _STATS[key]
+
+
+def _nbytes(value):
+    """
+    a cheap estimate of the memory held by a value submitted for writing
+    """
+    if is_pd(value):
+        n = value.memory_usage(index = True, deep = False)
+        return int(n if isinstance(n, int) else n.sum())
+    elif is_arr(value):
+        return value.nbytes
+    elif isinstance(value, dict):
+        return sum([_nbytes(v) for v in value.values()])
+    elif isinstance(value, (list, tuple)):
+        return sum([_nbytes(v) for v in value])
+    else:
+        return 0
+
+
+def _is_full(key, nbytes):
+    limits = _LIMITS.get(key)
+    if limits is None:
+        return False
+    stats = _stats(key)
+    if stats['queued'] == 0: ## we always allow a single write, however large
+        return False
+    if limits['max_pending'] is not None and stats['queued'] >= limits['max_pending']:
+        return True
+    if limits['max_bytes'] is not None and stats['queued_bytes'] + nbytes > limits['max_bytes']:
+        return True
+    return False
+
+
+def _write_done(key, path, nbytes, queued, future):
+    pool_name = key[1]
+    with _PENDING_LOCK:
+        entries = _PENDING.get(path, [])
+        entries[:] = [entry for entry in entries if entry[1] is not future]
+        if not entries:
+            _PENDING.pop(path, None)
+        stats = _stats(key)
+        if queued:
+            stats['queued'] -= 1
+            stats['queued_bytes'] -= nbytes
+        _PENDING_DONE.notify_all()
+        if future.cancelled():
+            stats['dropped'] += 1
+            return
+        e = future.exception()
+        if e is None:
+            stats['written'] += 1
+            _FAILED.pop((pool_name, path), None)
+        else:
+            stats['failed'] += 1
+            _FAILED[(pool_name, path)] = e
+    if e is not None:
+        logger.warning('WARN: asynchronous write to "%s" failed: %r'%(path, e))
+
+
+def submit_write(func, *args, path = None, max_workers = 4, pool_name = None, coalesce = False, shared = False):
+    """
+    submits func(*args) to the executor_pool(max_workers, pool_name) and registers the Future against path.
+    This allows us to flush() all pending writes and to have exceptions raised within the thread reported back to us.
+    
+    Writes to the same path are started one after the other, in the order they were submitted, even if the pool has several workers.
+    If coalesce is True, the write replaces the file at path entirely, so any earlier write to the same path that has not yet started is cancelled.
+    Writes that depend on existing data (appending to .npa files, bitemporal merges) must be submitted with coalesce = False so they are all applied, in order.
+
+    :Parameters:
+    ------------
+    func: callable
+        the writing function, run within the pool
+    args:
+        the parameters for func
+    path: str
+        the file location func writes to
+    max_workers: int
+        number of threads in the pool
+    pool_name: str
+        name of the pool
+    coalesce: bool
+        if True, supersedes earlier writes to path that have not started yet
+    shared: bool
+        if True and the pool is a process pool, DataFrames are shipped to the worker as Arrow tables in shared memory rather than pickled.
+        Arrow does not round trip every DataFrame (object columns, index freq), so only writers that convert to Arrow anyway (parquet) should set it.
+
+    :Returns:
+    ---------
+    a concurrent.futures.Future
+
+    :Example:
+    ---------
+    >>> from pyg_encoders import *
+    >>> import pandas as pd
+    >>> value = pd.DataFrame(dict(a = [1,2,3]))
+    >>> path = pd_to_parquet(value, 'c:/temp/submit_write.parquet')
+    >>> flush()
+    >>> assert len(pending()) == 0
+    >>> assert eq(pd_read_parquet(path), value)
+
+    :Example: coalescing writes in a tight loop
+    ---------
+    >>> from pyg import *
+    >>> value = pd.DataFrame(np.random.normal(0,1,(10000,26)), columns = list(ALPHABET), index = drange(-9999))
+    >>> for i in range(100):
+    >>>     pd_to_parquet(value + i, 'c:/temp/coalesce.parquet', max_workers = 1, pool_name = 'coalesce')
+    >>> flush('coalesce')
+    >>> assert write_stats('coalesce')['dropped'] > 0 ## most of the writes were superseded before they started
+    >>> assert eq(pd_read_parquet('c:/temp/coalesce.parquet'), value + 99)
+    """
+    key = (max_workers, pool_name)
+    pool = executor_pool(max_workers, pool_name)
+    nbytes = _nbytes(args) if key in _LIMITS else 0
+    if coalesce:
+        with _PENDING_LOCK:
+            superseded = [f for _, f in _PENDING.get(path, [])]
+        for f in superseded: ## cancel() fails for writes that are already running, and these will complete as normal
+            f.cancel()
+    sync = False
+    previous = None
+    with _PENDING_LOCK:
+        while _is_full(key, nbytes):
+            if _LIMITS[key]['when_full'] == 'sync' and not _PENDING.get(path): ## writing now would overtake the writes queued for path
+                sync = True
+                break
+            _PENDING_DONE.wait()
+        stats = _stats(key)
+        if sync:
+            future = Future()
+            future.set_running_or_notify_cancel()
+            stats['sync'] += 1
+        else: ## we launch once all earlier writes to path are done
+            future = Future()
+            previous = [f for _, f in _PENDING.get(path, [])]
+            stats['queued'] += 1
+            stats['queued_bytes'] += nbytes
+            stats['high_water'] = max(stats['high_water'], stats['queued'])
+            stats['high_water_bytes'] = max(stats['high_water_bytes'], stats['queued_bytes'])
+        _PENDING.setdefault(path, []).append((pool_name, future))
+        stats['submitted'] += 1
+    future.add_done_callback(lambda f: _write_done(key, path, nbytes, not sync, f))
+    if previous is not None:
+        _after(previous, lambda: _launch(pool, future, func, args, process = _KINDS.get(key) == 'process', shared = shared))
+    if sync:
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+    return future
+
+
+def pending(pool_name = None):
+    """
+    returns a dict of path to number of writes submitted to that path that have not yet completed
+
+    :Parameters:
+    ------------
+    pool_name: str
+        if provided, only writes submitted to pool_name are counted
+    """
+    with _PENDING_LOCK:
+        res = {path : len([f for name, f in entries if pool_name is None or name == pool_name]) for path, entries in _PENDING.items()}
+    return {path : n for path, n in res.items() if n > 0}
+
+
+def _is_pending(path):
+    """
+    True if a write to path was submitted and has not yet completed
+    """
+    with _PENDING_LOCK:
+        return len(_PENDING.get(path, [])) > 0
+
+
+def write_stats(pool_name = None):
+    """
+    returns counters of asynchronous writes:
+        
+    - submitted: number of writes submitted
+    - written: number of writes that completed successfully
+    - failed: number of writes that raised an exception
+    - dropped: number of writes superseded by a later write to the same path before they started
+    - sync: number of writes performed synchronously because the pool was full
+    - queued/queued_bytes: number of writes (and bytes they hold) currently in flight
+    - high_water/high_water_bytes: the maximum of queued/queued_bytes observed
+
+    :Parameters:
+    ------------
+    pool_name: str
+        if provided, only counts writes submitted to pool_name
+    """
+    with _PENDING_LOCK:
+        stats = [dict(v) for k, v in _STATS.items() if pool_name is None or k[1] == pool_name]
+    res = dict(submitted = 0, written = 0, failed = 0, dropped = 0, sync = 0, queued = 0, queued_bytes = 0, high_water = 0, high_water_bytes = 0)
+    for s in stats:
+        for k, v in s.items():
+            res[k] = max(res[k], v) if k.startswith('high_water') else res[k] + v
+    return res
+
+
+def flush(pool_name = None, timeout = None):
+    """
+    blocks until all writes submitted so far have completed.
+    If any of the writes failed, raises a WriteError with the exception raised for each of the failed paths.
+
+    :Parameters:
+    ------------
+    pool_name: str
+        if provided, only waits for writes submitted to pool_name
+    timeout: float
+        maximum number of seconds to wait. If writes are still pending after timeout, raises a TimeoutError
+
+    :Returns:
+    ---------
+    list of paths that were still pending when flush was called
+
+    :Example:
+    ---------
+    >>> from pyg import *
+    >>> paths = [pd_to_parquet(pd.Series(np.random.normal(0,1,1000)), 'c:/temp/flush/%i.parquet'%i) for i in range(100)]
+    >>> flush()
+    >>> assert len(pending()) == 0
+    >>> assert len(pd_read_parquet(paths[-1])) == 1000 ## safe to read back
+    """
+    with _PENDING_LOCK:
+        futures = {f : path for path, entries in _PENDING.items() for name, f in entries if pool_name is None or name == pool_name}
+    done, not_done = wait(list(futures), timeout = timeout)
+    if not_done:
+        raise TimeoutError('%i asynchronous write(s) still pending after %s seconds'%(len(not_done), timeout))
+    with _PENDING_LOCK: ## futures notify waiters before running their callbacks, so we wait for _write_done to record the outcome
+        while len(set(futures) & {f for entries in _PENDING.values() for _, f in entries}):
+            _PENDING_DONE.wait()
+        errors = {path : _FAILED.pop((name, path)) for name, path in list(_FAILED) if pool_name is None or name == pool_name}
+    if errors:
+        raise WriteError(errors)
+    return sorted(set(futures.values()))
+
+
+class write_barrier(object):
+    """
+    A context manager that flushes all pending writes on exit, re-raising any write errors as a WriteError.
+
+    :Example:
+    ---------
+    >>> from pyg import *
+    >>> with write_barrier():
+    >>>     for i in range(100):
+    >>>         pd_to_parquet(pd.Series(np.random.normal(0,1,1000)), 'c:/temp/barrier/%i.parquet'%i)
+    >>> s = pd_read_parquet('c:/temp/barrier/99.parquet') ## all files are now on disk
+    """
+    def __init__(self, pool_name = None, timeout = None):
+        self.pool_name = pool_name
+        self.timeout = timeout
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            flush(self.pool_name, self.timeout)
+        else: ## do not mask the original exception
+            try:
+                flush(self.pool_name, self.timeout)
+            except Exception as e:
+                logger.warning('WARN: %r raised while flushing writes after an exception'%e)
+        return False
@@ -1,8 +1,15 @@
-from pyg_encoders._encoders import csv_write, parquet_write, npy_write, pickle_write, _csv, _npy, _npa, _parquet, _pickle, _dictable, root_path
+from pyg_encoders._encoders import csv_write, parquet_write, npy_write, pickle_write, _csv, _npy, _npa, _parquet, _parqa, _pickle, _dictable, root_path, root_paths
+from pyg_encoders._encoders import _compile_root, _root_value, _branches, _pd_read_csv, _pd_read_parquet, _pd_read_npy, _pickle_load
+from pyg_encoders._cas import cas_write, _cas
+from pyg_encoders._manifest import read_manifest, _write_manifest, _manifest
 from pyg_encoders._encoders import pickle_load, pd_read_csv, pd_read_parquet
 from pyg_encoders._locks import _locked_pd_read_npy
-from pyg_encoders._encode import encode, decode 
-from pyg_base import passthru, is_str, as_list, get_cache, dt, dictattr, getargspec, partialize, dictdir
+from pyg_encoders._encode import encode, decode, Encoded, _PD_FORMATS
+from pyg_base import passthru, is_str, as_list, get_cache, dt, dictattr, getargspec, partialize, dictable
+from pyg_encoders._threads import executor_pool
+from concurrent.futures import as_completed
+from functools import partial
+import re
 import os
 
 _WRITERS = 'WRITERS'
@@ -20,31 +27,35 @@ WRITERS.update({_csv: csv_write ,
                '.np0': partialize(npy_write, append = False, max_workers = 0), 
                _npa: partialize(npy_write, append = True), 
                _parquet: parquet_write, 
+               _parqa: partialize(parquet_write, append = True), 
                '.parque0' : partialize(parquet_write, max_workers = 0),
                '.pickl0' : partialize(pickle_write, max_workers = 0),
-               _pickle : pickle_write})
+               _pickle : pickle_write,
+               _cas : cas_write})
 
 READERS.update({_csv: pd_read_csv,
                 _pickle: pickle_load, 
                 _npy : _locked_pd_read_npy, 
                 _npa: _locked_pd_read_npy,
-                _parquet: pd_read_parquet
+                _parquet: pd_read_parquet,
+                _parqa: pd_read_parquet
                 })
 
-def as_reader(reader = None):
+def as_reader(reader = None, lazy = False):
     """
         returns a list of functions that are applied to an object to turn it into a valid document
+        if lazy, the default decoder leaves file-backed objects unread until they are used, see decode(..., lazy = True)
     """
     if isinstance(reader, list):
-        return sum([as_reader(r) for r in reader], [])
+        return sum([as_reader(r, lazy = lazy) for r in reader], [])
     elif reader is None or reader is True or reader == ():
-        return [decode]
+        return [partial(decode, lazy = True)] if lazy else [decode]
     elif reader is False or reader == 0:
         return [passthru]
     else:
         return [reader]
 
-def as_writer(writer = None, kwargs = None, unchanged = None, unchanged_keys = None, asof = None, **writer_kwargs):
+def as_writer(writer = None, kwargs = None, unchanged = None, unchanged_keys = None, asof = None, pd_format = None, **writer_kwargs):
     """
     returns a list of functions that convert a document into an object that can be pushed into the storage mechanism we want
 
@@ -59,6 +70,9 @@ def as_writer(writer = None, kwargs = None, unchanged = None, unchanged_keys = N
         inputs into the 'encode' function, allowing us to not-encode some of the values in document based on their type
     unchanged_keys : str/list of str, optional
         inputs into the 'encode' function, allowing us to not-encode some of the keys in document 
+    pd_format : str, optional
+        inputs into the 'encode' function: how pandas objects left in the document are stored, 'pickle', 'arrow', 'lz4' or 'zstd'.
+        writer can also be one of these, e.g. as_writer('zstd') stores pandas objects within the document as zstd compressed Arrow IPC.
     writer_kwargs:
         parameters specific to the writer we load, which we don't know in advance
 
@@ -74,8 +88,10 @@ def as_writer(writer = None, kwargs = None, unchanged = None, unchanged_keys = N
 
     """
     if isinstance(writer, list):
-        return sum([as_writer(w, kwargs = kwargs, unchanged = unchanged, unchanged_keys=unchanged_keys, asof = asof) for w in writer], [])
-    e = encode if unchanged is None and unchanged_keys is None else partialize(encode, unchanged = unchanged, unchanged_keys = unchanged_keys)
+        return sum([as_writer(w, kwargs = kwargs, unchanged = unchanged, unchanged_keys=unchanged_keys, asof = asof, pd_format = pd_format) for w in writer], [])
+    if is_str(writer) and writer in _PD_FORMATS:
+        writer, pd_format = None, writer
+    e = encode if unchanged is None and unchanged_keys is None and pd_format is None else partialize(encode, unchanged = unchanged, unchanged_keys = unchanged_keys, pd_format = pd_format)
     if writer is None or writer is True or writer == ():
         return [e]
     elif writer is False or writer == 0:
@@ -101,25 +117,108 @@ def as_writer(writer = None, kwargs = None, unchanged = None, unchanged_keys = N
 
 
 
-def _np_read_path(pth, ext, level = 0):
-    reader = READERS[ext]
-    if os.path.exists(pth) and os.path.exists(os.path.join(pth, 'data.npy')) and os.path.exists(os.path.join(pth, 'index.npy')):
-        return reader(pth + ext)
-    else:
-        return dictattr({k: _np_read_path(p, ext) for k,p in dictdir(pth, level = level).items()})/None
+class _read_task(object):
+    """
+    a file to be read by reader, a leaf of the tree planned by _pd_plan_path
+    """
+    def __init__(self, keys, reader, path, **kwargs):
+        self.keys = keys
+        self.reader = reader
+        self.path = path
+        self.kwargs = kwargs
+    
+    def __call__(self):
+        return self.reader(self.path, **self.kwargs)
+
 
-def _pd_read_path(pth, ext, level = 0):
+def _scandir(pth):
+    try:
+        with os.scandir(pth) as it:
+            return [(e.name, e.path, e.is_dir()) for e in it]
+    except OSError: # does not exist or no permission
+        return None
+
+
+def _np_plan_path(pth, ext, keys, tasks, mmap = False):
+    entries = _scandir(pth)
+    if entries is None:
+        return None
+    names = [name for name, _, _ in entries]
+    if 'data.npy' in names and 'index.npy' in names:
+        task = _read_task(keys, READERS[ext], pth + ext, mmap = True) if mmap else _read_task(keys, READERS[ext], pth + ext)
+        tasks.append(task)
+        return task
+    return dictattr({name: _np_plan_path(p, ext, keys + (name,), tasks, mmap = mmap) for name, p, is_dir in entries if is_dir})
+
+
+def _pd_plan_path(pth, ext, keys, tasks, mmap = False, level = 0):
+    """
+    lists the files we need to read for pth with a single os.scandir per directory, appending a _read_task per file to tasks.
+    Returns the tree of dicts whose leaves are these tasks.
+    If level > 0, we also descend level directories into nested dicts of outputs, e.g. data/a/b.parquet
+    """
     if 'np' in ext:
-        return _np_read_path(pth, ext, level)
+        return _np_plan_path(pth, ext, keys, tasks, mmap = mmap)
     reader = READERS[ext]
+    if ext == _parqa: ## appended parquet files are stored as .parquet
+        ext = _parquet
     if os.path.exists(pth + ext):
-        return reader(pth + ext)
-    elif os.path.exists(pth):
-        return dictattr({k[:-len(ext)]: reader(v) for k, v in dictdir(pth, level = level).items() if k.endswith(ext)})/None
-        
-    
+        task = _read_task(keys, reader, pth + ext)
+        tasks.append(task)
+        return task
+    entries = _scandir(pth)
+    if entries is None:
+        return None
+    res = dictattr()
+    for name, p, is_dir in entries:
+        if is_dir:
+            if level > 0 and '.' not in name: ## not the .deltas/.parts/.dictable directories of a file
+                res[name] = _pd_plan_path(p, ext, keys + (name,), tasks, mmap = mmap, level = level - 1)
+        elif name.endswith(ext):
+            res[name[:-len(ext)]] = task = _read_task(keys + (name[:-len(ext)],), reader, p)
+            tasks.append(task)
+    return res
 
-def pd_read_root(root, doc = None, output = None, level = 0):
+
+def _pd_plan_output(path, out, ext, keys, tasks, mmap = False, manifest = None, level = 0):
+    """
+    plans the read of output out of the document in directory path. 
+    If the writer left a manifest listing out, we decode its reference rather than probing the directory.
+    """
+    if manifest is not None and out in manifest:
+        task = _read_task(keys, _decode_ref, manifest[out]['ref'])
+        tasks.append(task)
+        return task
+    return _pd_plan_path(os.path.join(path, out), ext, keys, tasks, mmap = mmap, level = level)
+
+
+def _pd_resolve(tree, values):
+    if isinstance(tree, _read_task):
+        return values[id(tree)]
+    elif isinstance(tree, dict):
+        return dictattr({k: _pd_resolve(v, values) for k, v in tree.items()}) / None
+    return tree
+
+
+def _decode_ref(ref):
+    return _pd_resolve(decode(ref), {}) ## dicts are returned as dictattr, as when we list the directory
+
+
+def _pd_read_tasks(tasks, max_workers = 0):
+    """
+    runs the tasks in executor_pool(max_workers, 'read'), yielding (task, value) as each completes
+    """
+    if max_workers and len(tasks) > 1:
+        executor = executor_pool(max_workers, name = 'read')
+        futures = {executor.submit(task): task for task in tasks}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    else:
+        for task in tasks:
+            yield task, task()
+
+
+def pd_read_root(root, doc = None, output = None, level = 0, mmap = False, max_workers = 4, stream = False):
     """
     
     Returns a list of dataframes 
@@ -171,10 +270,34 @@ def pd_read_root(root, doc = None, output = None, level = 0):
         A document to populate the root keys from.
     output : str/list, optional
         list of keys we are interested to load from file
+    level : int, optional
+        how many levels of subdirectories to read for outputs that are nested dicts, e.g. level = 1 reads data/a/b.parquet as res['data']['a']['b']. 
+        npy outputs are always read to any depth.
+    mmap : bool, optional
+        for .npy/.npa files, returns DataFrames backed by read-only memory-mapped files, shared with other processes via the page cache
+    max_workers : int, optional
+        number of threads in executor_pool(max_workers, 'read') reading the files concurrently. 0 reads them one by one in the current thread.
+    stream : bool, optional
+        if True, returns a generator of (keys, value) for each file as soon as it is read, where keys is a tuple such as ('data', 'add')
 
     Returns
     -------
     dict of values
+    
+    Example: reading a dict of several hundred files
+    --------
+    >>> from pyg import *
+    >>> root = 'c:/temp/%x/%y.parquet'
+    >>> f = lambda n: {'%i'%i : pd.Series(np.random.normal(0,1,100), drange(-99)) for i in range(n)}
+    >>> doc = cell(f, n = 500, x = 'x', y = 'many', db = root).go()
+    >>> serial_time = timer(pd_read_root, n = 10, time = True)(root, doc, max_workers = 0)
+    >>> parallel_time = timer(pd_read_root, n = 10, time = True)(root, doc, max_workers = 8)
+    
+    Each read mostly waits on the disk, so on a network share the speedup is close to linear in max_workers.
+    On a single core with a local disk, decoding parquet is CPU bound and the two times are similar (~1.0s vs ~1.2s for 500 files).
+    
+    >>> for keys, value in pd_read_root(root, doc, stream = True): ## ('data', '17'), pd.Series
+    >>>     pass
         
     """
     doc = doc or {}
@@ -185,8 +308,269 @@ def pd_read_root(root, doc = None, output = None, level = 0):
 
     ext = '.' + root.split('.')[-1]
     path = path[:-len(ext)]
+    tasks = []
+    manifest = None if mmap else read_manifest(path) ## a single read rather than probing for each output
     for out in output:
         if doc.get(out) is None:
-            pth = os.path.join(path, out)
-            res[out] = _pd_read_path(pth, ext, level)
-    return res / None
+            res[out] = _pd_plan_output(path, out, ext, (out,), tasks, mmap = mmap, manifest = manifest, level = level)
+    if stream:
+        return ((task.keys, value) for task, value in _pd_read_tasks(tasks, max_workers))
+    values = {id(task) : value for task, value in _pd_read_tasks(tasks, max_workers)}
+    return _pd_resolve(res, values)
+
+
+_glob_key = re.compile(r'[A-Za-z0-9_.]*[A-Za-z0-9]')
+
+
+def _glob_keys(compiled):
+    """
+    without a document we cannot tell how much of %pupil.name_ is the key, so we take the longest prefix that does not end with _ or .
+    Use %(key) to be explicit.
+    """
+    res = []
+    for part in compiled:
+        if is_str(part):
+            res.append(part)
+        else:
+            text, keys = part
+            if text.startswith('%('):
+                res.append((keys[0][0], ''))
+            else:
+                match = _glob_key.match(text[1:])
+                if match is None:
+                    res.append(text)
+                else:
+                    res.append((match.group(0), text[1 + match.end():]))
+    return res
+
+
+def _glob_segments(root):
+    """
+    splits the root (without its extension) into its static prefix and a regex per directory level that contain keys
+    """
+    parts = _glob_keys(_compile_root(root.replace('\\', '/')))
+    segments = [[]]
+    for part in parts:
+        if is_str(part):
+            texts = part.split('/')
+            segments[-1].append(texts[0])
+            for text in texts[1:]:
+                segments.append([text])
+        else:
+            segments[-1].append(part)
+    prefix = []
+    while len(segments) and min([is_str(p) for p in segments[0]]):
+        prefix.append(''.join(segments.pop(0)))
+    regexes = []
+    for segment in segments:
+        names = []
+        pattern = ''
+        for p in segment:
+            if is_str(p):
+                pattern += re.escape(p)
+            else:
+                key, remainder = p
+                pattern += '(.+?)' + re.escape(remainder)
+                names.append(key)
+        regexes.append((re.compile(pattern + '$'), names))
+    return '/'.join(prefix), regexes
+
+
+def _glob_dirs(path, regexes, keys):
+    """
+    walks down path one level per regex, listing each directory once and yielding (keys, directory) for those matching all levels
+    """
+    if len(regexes) == 0:
+        yield keys, path
+        return
+    regex, names = regexes[0]
+    for name, p, is_dir in _scandir(path) or []:
+        if not is_dir:
+            continue
+        match = regex.match(name)
+        if match is None:
+            continue
+        found = dict(keys)
+        for key, value in zip(names, match.groups()):
+            if found.setdefault(key, value) != value: ## the same key appears twice in the root with different values
+                break
+        else:
+            yield from _glob_dirs(p, regexes[1:], found)
+
+
+def _doc_keys(doc, compiled):
+    res = {}
+    for part in compiled:
+        if not is_str(part):
+            for key, remainder in part[1]:
+                value = _root_value(doc, key)
+                if value is not _branches:
+                    res[key] = value
+                    break
+    return res
+
+
+def pd_read_roots(root, docs = None, output = None, mmap = False, max_workers = 4):
+    """
+    reads the files of many documents sharing the same root, returning a dictable with a column per key in root and per output.
+    This is the bulk version of calling pd_read_root(root, doc) in a loop:
+    
+    - if docs are provided, their paths are resolved with a single compiled root and each parent directory is listed once, rather than probing each file with os.path.exists
+    - if docs is None, we walk the directories matching the root once, parsing the keys from the directory names, e.g. all %country and %city under d:/archive
+    
+    All the files are then read concurrently in executor_pool(max_workers, 'read').
+
+    :Parameters:
+    ----------
+    root : str
+        Such as 'd:/archive/%country/%city/results.parquet'
+    docs : list of dicts, optional
+        documents to populate the root keys from. If None, all directories matching root are read.
+    output : str/list, optional
+        keys we want to load from file. Defaults to each document's _output or 'data'
+    mmap : bool, optional
+        for .npy/.npa files, returns DataFrames backed by read-only memory-mapped files
+    max_workers : int, optional
+        number of threads reading the files. 0 reads them one by one in the current thread.
+
+    :Returns:
+    -------
+    dictable
+        with one row per document (or per directory found) 
+
+    :Example:
+    ---------
+    >>> from pyg import *
+    >>> root = 'c:/temp/archive/%country/%city/results.parquet'
+    >>> docs = [dict(country = country, city = '%s_%i'%(country, i), data = pd.Series(np.random.normal(0,1,100), drange(-99))) for country in ['uk', 'us', 'fr'] for i in range(1000)]
+    >>> for doc in docs:
+    >>>     parquet_write(doc, root, max_workers = 0)
+    >>> keys = [dict(country = doc['country'], city = doc['city']) for doc in docs]
+    >>> loop_time = timer(lambda: [pd_read_root(root, doc) for doc in keys], time = True)()
+    >>> bulk_time = timer(pd_read_roots, time = True)(root, keys, max_workers = 8)
+    >>> rs = pd_read_roots(root) ## walks c:/temp/archive once
+    >>> assert len(rs) == 3000 and rs.keys() == ['country', 'city', 'data']
+    """
+    compiled = _compile_root(root)
+    ext = '.' + root.split('.')[-1]
+    tasks = []
+    rows = []
+    planned = []
+    if docs is None:
+        output = as_list(output or 'data')
+        prefix, regexes = _glob_segments(root[:-len(ext)])
+        for keys, path in _glob_dirs(prefix or '.', regexes, {}):
+            row = dict(keys)
+            manifest = None if mmap else read_manifest(path)
+            for out in output:
+                row[out] = _pd_plan_output(path, out, ext, (len(rows), out), tasks, mmap = mmap, manifest = manifest)
+                planned.append((len(rows), out))
+            rows.append(row)
+    else:
+        listings = {}
+        for doc, path in zip(docs, root_paths(docs, root)):
+            path = path[:-len(ext)]
+            row = _doc_keys(doc, compiled)
+            outs = as_list(output or getattr(doc, '_output', 'data'))
+            parent, name = os.path.split(path)
+            if parent not in listings:
+                listings[parent] = set([n for n, _, is_dir in _scandir(parent) or [] if is_dir])
+            manifest = read_manifest(path) if name in listings[parent] and not mmap else None
+            for out in outs:
+                if doc.get(out) is not None: ## as in pd_read_root, we only read what the document does not already have
+                    row[out] = doc[out]
+                    continue
+                if name in listings[parent]:
+                    row[out] = _pd_plan_output(path, out, ext, (len(rows), out), tasks, mmap = mmap, manifest = manifest)
+                else:
+                    row[out] = None
+                planned.append((len(rows), out))
+            rows.append(row)
+    values = {id(task) : value for task, value in _pd_read_tasks(tasks, max_workers)}
+    for i, out in planned:
+        rows[i][out] = _pd_resolve(rows[i][out], values)
+    return dictable(rows)
+
+
+_ENCODED_READERS = {pd_read_csv : _pd_read_csv, pd_read_parquet : _pd_read_parquet, _locked_pd_read_npy : _pd_read_npy, pickle_load : _pickle_load}
+
+
+def _shape(path, ext):
+    try:
+        if ext == _parquet:
+            import pyarrow.parquet as pq
+            metadata = pq.read_metadata(path)
+            index = [c for c in (metadata.schema.to_arrow_schema().pandas_metadata or {}).get('index_columns', []) if is_str(c)]
+            return [metadata.num_rows, metadata.num_columns - len(index)]
+        elif 'np' in ext:
+            import numpy as np
+            return list(np.load(os.path.join(path[:-len(ext)], 'data.npy'), mmap_mode = 'r').shape)
+    except Exception:
+        pass
+    return None
+
+
+def _manifest_entry(tree, fmt, files):
+    if isinstance(tree, _read_task):
+        files.append(dict(path = tree.path, format = fmt, shape = _shape(tree.path, fmt), mtime = os.stat(tree.path).st_mtime if os.path.exists(tree.path) else None, asof = None))
+        return Encoded(_obj = _ENCODED_READERS[tree.reader], path = tree.path)
+    elif isinstance(tree, dict):
+        tree = {k : _manifest_entry(v, fmt, files) for k, v in tree.items()}
+        return {k : v for k, v in tree.items() if v is not None}
+    return tree
+
+
+def rebuild_manifest(root, docs = None):
+    """
+    writes the manifests that pd_read_root consults, for documents that were written without manifest = True.
+    Each document's directory is listed once and the files found for each output are recorded, as write_manifest would have.
+
+    :Parameters:
+    ----------
+    root : str
+        Such as 'd:/archive/%country/%city/results.parquet'
+    docs : list of dicts, optional
+        the documents whose manifests we rebuild. If None, all directories matching root are.
+
+    :Returns:
+    -------
+    list of manifest paths written
+
+    :Example:
+    ---------
+    >>> from pyg import *
+    >>> root = 'c:/temp/archive/%country/%city/results.parquet'
+    >>> rebuild_manifest(root) ## once for the existing tree
+    >>> doc = dict(country = 'uk', city = 'london', data = pd.Series([1,2,3]))
+    >>> as_writer(root, manifest = True)[0](doc) ## new documents maintain their manifest as they are written
+    >>> pd_read_root(root, dict(country = 'uk', city = 'london')) ## reads the manifest and then the files, without listing the directory
+    """
+    ext = '.' + root.split('.')[-1]
+    if docs is None:
+        prefix, regexes = _glob_segments(root[:-len(ext)])
+        paths = [path for _, path in _glob_dirs(prefix or '.', regexes, {})]
+    else:
+        paths = [path[:-len(ext)] for path in root_paths(docs, root)]
+    res = []
+    for path in paths:
+        entries = _scandir(path)
+        if entries is None:
+            continue
+        manifest = {}
+        fmt = _parquet if ext == _parqa else ext
+        for name, p, is_dir in entries:
+            if is_dir and '.' not in name: ## skipping x.parquet.parts, x.dictable and other directories that are not outputs
+                out = name
+            elif not is_dir and name.endswith(fmt):
+                out = name[:-len(fmt)]
+            else:
+                continue
+            if out in manifest:
+                continue
+            files = []
+            tree = _pd_plan_path(os.path.join(path, out), ext, (out,), [])
+            ref = _manifest_entry(tree, fmt, files)
+            if len(files):
+                manifest[out] = dict(ref = ref, files = files)
+        res.append(_write_manifest(os.path.join(path, _manifest), manifest))
+    return res
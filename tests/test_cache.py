@@ -0,0 +1,52 @@
+from pyg_base import eq, drange
+from pyg_encoders import decode, decode_cache, cache_stats, pd_to_parquet
+from pyg_encoders._encoders import parquet_encode, npy_encode
+import pandas as pd
+import numpy as np
+import os
+import pytest
+
+
+@pytest.fixture
+def cache():
+    decode_cache(True, max_bytes = 2**30)
+    cache_stats(reset = True)
+    yield
+    decode_cache(False)
+
+
+def test_decode_cache_hits_and_writer_invalidates(tmp_path, cache):
+    value = pd.DataFrame(np.random.normal(0,1,(100,3)), drange(-99), columns = ['a', 'b', 'c'])
+    doc = parquet_encode(value, str(tmp_path / 'a.parquet'), max_workers = 0)
+    assert eq(decode(doc), value)
+    assert eq(decode(doc), value)
+    stats = cache_stats()
+    assert stats['hits'] == 1 and stats['misses'] == 1 and stats['entries'] == 1
+    decode(doc)['a'] = 0 ## callers get a copy and cannot alter the cached value's columns
+    assert eq(decode(doc), value)
+    parquet_encode(value + 1, str(tmp_path / 'a.parquet'), max_workers = 0)
+    assert cache_stats()['invalidations'] == 1
+    assert eq(decode(doc), value + 1)
+
+
+def test_decode_cache_detects_external_changes(tmp_path, cache):
+    path = str(tmp_path / 'a.parquet')
+    value = pd.DataFrame(dict(a = [1.,2.,3.]), drange(2))
+    doc = parquet_encode(value, path, max_workers = 0)
+    assert eq(decode(doc), value)
+    (value * 10).to_parquet(path) ## not via our writers, e.g. another process
+    os.utime(path, ns = (0, 10**18))
+    assert eq(decode(doc), value * 10)
+
+
+def test_decode_cache_evicts_by_bytes(tmp_path, cache):
+    a = pd.Series(np.arange(1000.), drange(-999))
+    docs = [npy_encode(a + i, str(tmp_path / ('%i.npy'%i)), max_workers = 0) for i in range(3)]
+    decode_cache(True, max_bytes = 2 * a.memory_usage(index = True) + 100)
+    for doc in docs:
+        decode(doc)
+    stats = cache_stats()
+    assert stats['entries'] == 2 and stats['evictions'] == 1
+    assert stats['bytes'] <= stats['max_bytes']
+    assert eq(decode(docs[0]), a)
+    assert cache_stats()['misses'] == 4
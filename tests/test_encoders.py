@@ -33,6 +33,14 @@ def test_root_path():
     assert root_path(doc, root) == 'c:/yoav/git/%age/'
 
 
+def test_root_paths():
+    from pyg_encoders import root_paths
+    docs = [dict(x = 'X', x_y = 'XY', pupil = dict(name = name), data = s, i = {0 : 'zero'}) for name in ['a', 'b']]
+    root = 'c:/%x_y/%x_/%(x)y/%pupil.name.%i.0/%pupil/%missing.parquet'
+    assert root_paths(docs, root) == ['c:/XY/X_/Xy/%s.zero/%%pupil/%%missing.parquet'%name for name in 'ab']
+    assert root_paths(docs, 'c:/%key/%x', key = 'k') == ['c:/k/X', 'c:/k/X']
+
+
 def test_parquet_write():
     root = 'c:/test/%key1/%key2.parquet'
     res = parquet_write(doc, root)
@@ -82,3 +90,256 @@ def test_pickle_write():
     self = db_cell(add_, a = a, b = b, key = 'c', db = 'c:/test/%key.pickle').load()
     assert eq(self.data, a+b)
     assert eq(pickle_load('c:/test/c.pickle')['data'], a+b)
+
+
+def test_npy_write_mmap(tmp_path):
+    from pyg_encoders import pd_read_root, flush
+    root = str(tmp_path / '%key1/%key2.npy')
+    res = npy_write(dict(s = s, key1 = 'a', key2 = 'b'), root, append = False, max_workers = 0, mmap = True)
+    assert res['s']['mmap'] is True
+    s2 = decode(res['s'])
+    assert eq(s2, s)
+    assert isinstance(s2.values.base, np.memmap) or isinstance(s2.values.base.base, np.memmap)
+    read = pd_read_root(root, dict(key1 = 'a', key2 = 'b'), output = ['s'], mmap = True)
+    assert eq(read['s'], s)
+
+
+def test_pd_read_root_concurrent(tmp_path):
+    from pyg_encoders import pd_read_root
+    data = {'%i'%i : s * i for i in range(20)}
+    for ext in ['parquet', 'npy']:
+        root = str(tmp_path / ('%key1/%key2.' + ext))
+        writer = parquet_write if ext == 'parquet' else partial(npy_write, append = False)
+        writer(dict(data = data, s = s, key1 = 'a', key2 = 'b'), root, max_workers = 0)
+        serial = pd_read_root(root, dict(key1 = 'a', key2 = 'b'), output = ['data', 's'], max_workers = 0)
+        parallel = pd_read_root(root, dict(key1 = 'a', key2 = 'b'), output = ['data', 's'], max_workers = 4)
+        assert eq(serial, parallel) and sorted(parallel['data']) == sorted(data) and eq(parallel['s'], s)
+        assert all([eq(parallel['data'][k], v) for k, v in data.items()])
+        streamed = dict(pd_read_root(root, dict(key1 = 'a', key2 = 'b'), output = ['data', 's'], max_workers = 4, stream = True))
+        assert len(streamed) == 21 and eq(streamed[('data', '7')], s * 7) and eq(streamed[('s',)], s)
+    root = str(tmp_path / '%key1/nested.parquet')
+    parquet_write(dict(data = dict(a = dict(b = s), c = s * 2), key1 = 'a'), root, max_workers = 0)
+    assert sorted(pd_read_root(root, dict(key1 = 'a'))['data']) == ['c']
+    nested = pd_read_root(root, dict(key1 = 'a'), level = 1)['data']
+    assert eq(nested['a']['b'], s) and eq(nested['c'], s * 2)
+
+
+def test_pd_read_roots(tmp_path):
+    from pyg_encoders import pd_read_roots
+    root = str(tmp_path / 'archive/%country/%city/results.parquet')
+    docs = [dict(country = country, city = '%s_%i'%(country, i), data = s * i, stats = dict(a = s + i)) for country in ['uk', 'us'] for i in range(3)]
+    for doc in docs:
+        parquet_write(doc, root, max_workers = 0)
+    keys = [dict(country = doc['country'], city = doc['city']) for doc in docs] + [dict(country = 'fr', city = 'paris')]
+    rs = pd_read_roots(root, keys, output = ['data', 'stats'])
+    assert rs.city == [doc['city'] for doc in docs] + ['paris']
+    assert all([eq(a, doc['data']) and eq(b['a'], doc['stats']['a']) for a, b, doc in zip(rs.data, rs.stats, docs)])
+    assert rs.data[-1] is None
+    rs = pd_read_roots(root, max_workers = 0)
+    assert sorted(rs.city) == sorted([doc['city'] for doc in docs])
+    assert all([eq(row.data, s * int(row.city[-1])) and row.country == row.city[:2] for row in rs])
+
+
+def test_manifest(tmp_path):
+    from pyg_encoders import pd_read_root, pd_read_roots, read_manifest, rebuild_manifest
+    for ext, writer in [('parquet', parquet_write), ('npy', partial(npy_write, append = False))]:
+        root = str(tmp_path / ('%key1/%key2.' + ext))
+        writer(dict(data = dict(a = s, b = s * 2), s = s, key1 = 'm', key2 = ext), root, max_workers = 0, manifest = True)
+        writer(dict(data = dict(a = s, b = s * 2), s = s, key1 = 'r', key2 = ext), root, max_workers = 0)
+        manifest = read_manifest(str(tmp_path / 'm' / ext))
+        assert sorted(manifest) == ['data', 's'] and len(manifest['data']['files']) == 2 and manifest['s']['files'][0]['shape'] == [3]
+        read = pd_read_root(root, dict(key1 = 'm', key2 = ext), output = ['data', 's'])
+        assert eq(read['s'], s) and eq(read['data']['b'], s * 2)
+        assert read_manifest(str(tmp_path / 'r' / ext)) is None
+        rebuild_manifest(root)
+        manifest = read_manifest(str(tmp_path / 'r' / ext))
+        assert sorted(manifest) == ['data', 's'] and len(manifest['data']['files']) == 2
+        rs = pd_read_roots(root, [dict(key1 = 'r', key2 = ext)], output = ['data', 's'])
+        assert eq(rs[0].s, s) and eq(rs[0].data['a'], s)
+        writer(dict(data = dict(a = s, b = s * 2, c = s * 3), s = s, key1 = 'm', key2 = ext), root, max_workers = 0) ## without a manifest
+        assert read_manifest(str(tmp_path / 'm' / ext)) is None
+        assert eq(pd_read_root(root, dict(key1 = 'm', key2 = ext))['data']['c'], s * 3)
+    root = str(tmp_path / 'bi/%key.parquet')
+    parquet_write(dict(data = s, key = 'm'), root, asof = dt(2020,1,1), max_workers = 0, manifest = True)
+    parquet_write(dict(data = s, key = 'r'), root, asof = dt(2020,1,1), max_workers = 0)
+    assert eq(pd_read_root(root, dict(key = 'm'))['data'], pd_read_root(root, dict(key = 'r'))['data']) ## the manifest decodes as listing the directory does
+
+
+def test_fingerprint_skips_unchanged_writes(tmp_path):
+    import os
+    from pyg_encoders import content_hash, pickle_encode, npy_encode
+    assert content_hash(df) == content_hash(df.copy()) != content_hash(df.iloc[:2])
+    assert content_hash(s) != content_hash(s + 1)
+    for encoder, fname in [(parquet_encode, 'x.parquet'), (pickle_encode, 'x.pickle'), (npy_encode, 'x/data.npy')]:
+        path = str(tmp_path / encoder.__name__ / 'x')
+        res = encoder(s, path, max_workers = 0, fingerprint = True)
+        assert res['fingerprint'] == content_hash(s)
+        stat = os.stat(os.path.join(os.path.dirname(path), fname))
+        assert eq(decode(encoder(s, path, max_workers = 0, fingerprint = True)), s)
+        new = os.stat(os.path.join(os.path.dirname(path), fname))
+        assert (new.st_ino, new.st_mtime_ns) == (stat.st_ino, stat.st_mtime_ns) ## not rewritten
+        assert eq(decode(encoder(s + 1, path, max_workers = 0, fingerprint = True)), s + 1)
+        encoder(s, path, max_workers = 0, fingerprint = True)
+        encoder(s * 2, path, max_workers = 0) ## a write without a fingerprint invalidates the recorded one
+        assert eq(decode(encoder(s, path, max_workers = 0, fingerprint = True)), s)
+
+
+def test_fingerprint_sees_queued_writes(tmp_path):
+    from pyg_encoders import flush, pd_to_parquet, pd_read_parquet
+    from pyg_encoders._locks import _LOCKS
+    path = str(tmp_path / 'x.parquet')
+    pd_to_parquet(s, path, max_workers = 0, fingerprint = True)
+    with _LOCKS.write(path): ## the write of s + 1 is queued behind us
+        pd_to_parquet(s + 1, path, max_workers = 1, fingerprint = True)
+        pd_to_parquet(s, path, max_workers = 1, fingerprint = True)
+    flush()
+    assert eq(pd_read_parquet(path), s)
+
+
+def test_cas_write_stores_duplicates_once(tmp_path):
+    import os
+    from pyg_base import dictable
+    from pyg_encoders import cas_gc, content_hash, flush
+    root = str(tmp_path / 'store')
+    writer = as_writer(root + '.cas')[0]
+    a = writer(dict(key = 'a', x = df, y = df.copy(), n = np.arange(3.), data = dictable(a = [1,2], b = [s, s])))
+    b = writer(dict(key = 'b', x = df, z = s + 1))
+    flush()
+    assert a['x']['path'] == a['y']['path'] == b['x']['path']
+    assert a['x']['fingerprint'] == content_hash(df)
+    assert eq(decode(a)['y'], df) and eq(decode(a)['n'], np.arange(3.)) and eq(decode(a)['data'], dictable(a = [1,2], b = [s, s]))
+    assert eq(decode(b)['z'], s + 1)
+    assert cas_gc(root, [a, b], min_age = 0) == []
+    assert cas_gc(root, [a], min_age = 60) == [] ## z was written just now
+    removed = cas_gc(root, [a], min_age = 0)
+    assert removed == [b['z']['path']] and not os.path.exists(b['z']['path'])
+    assert eq(decode(a)['x'], df)
+    from pyg_base import add_
+    c = writer(dict(key = 'c', data = dictable(a = [np.int64(1), np.int64(2)], f = [add_, add_], b = [s, s])))
+    assert [type(v) for v in c['data']['df']['a']] == [int, int] and isinstance(c['data']['df']['f'][0], str) ## encoded, as the document goes to mongo
+    assert decode(c)['data'].f == [add_, add_] and eq(decode(c)['data'].b[0], s)
+
+
+def test_decode_lazy(tmp_path):
+    from pyg_encoders import LazyValue, materialize
+    value = dict(a = s, b = dict(c = s * 2), d = np.arange(3.))
+    res = parquet_encode(value, str(tmp_path / 'lazy'), max_workers = 0)
+    lazy = decode(res, lazy = True)
+    assert isinstance(lazy['a'], LazyValue) and isinstance(lazy['b']['c'], LazyValue) and isinstance(lazy['d'], LazyValue)
+    assert eq(lazy['a'].iloc[-1], 3.)
+    assert eq((lazy['b']['c'] + 1).values, (s * 2 + 1).values)
+    assert eq(materialize(lazy), value)
+    assert eq(decode(res), value)
+    assert isinstance(as_reader(None, lazy = True)[0](res)['a'], LazyValue)
+    with pytest.raises(ValueError):
+        decode(res, lazy = True, parallel = True)
+
+
+def _slow_read(path):
+    import time
+    time.sleep(0.2) ## a network share
+    return path
+
+
+def test_decode_many_reads_concurrently():
+    from pyg_encoders import decode_many
+    from pyg_encoders._encode import _FILE_READERS
+    import time
+    _FILE_READERS.add(_slow_read)
+    try:
+        docs = [dict(a = dict(_obj = _slow_read, path = 'a%i'%i), b = [dict(_obj = _slow_read, path = 'b%i'%i)]) for i in range(4)]
+        t0 = time.time()
+        res = decode_many(docs, max_workers = 8)
+        assert time.time() - t0 < 0.2 * 8 / 2
+        assert res == [dict(a = 'a%i'%i, b = ['b%i'%i]) for i in range(4)]
+        assert decode(docs[0], parallel = True) == dict(a = 'a0', b = ['b0'])
+    finally:
+        _FILE_READERS.discard(_slow_read)
+
+
+def test_encode_fast_path_matches_slow_path():
+    from pyg_encoders._encode import _encode, _encode_value, _decode, _decode_value, Encoded
+    from pyg_base import Dict, dictable, add_
+    values = [1, 1.5, True, np.bool_(False), np.int32(3), np.float32(2.5), 'x', None, dt(2000,1,1), [1,(2,3)], dict(a = 1, b = [np.int64(2)]), 
+              Dict(a = 1), dictable(a = [1,2]), partial(add_, b = 1), add_, int, np.arange(3.), s, df]
+    for value in values:
+        encoded = _encode(value)
+        assert type(encoded) == type(_encode_value(value))
+        assert eq(decode(encoded), decode(_encode_value(value)))
+        assert eq(_decode(encoded), _decode_value(encoded))
+    assert eq(decode(encode(values)), values)
+    assert encode(dict(a = s), unchanged = pd.Series)['a'] is s
+    assert decode(['2000-01-01T00:00:00', 'null'], date = True) == [dt(2000,1,1), None]
+
+
+def test_encoded_is_not_walked_again(tmp_path):
+    from pyg_encoders import Encoded
+    res = parquet_encode(dict(s = s), str(tmp_path), max_workers = 0)
+    assert isinstance(res['s'], Encoded)
+    encoded = encode(res)
+    assert type(encoded['s']) == dict and encoded['s'] == res['s']
+    assert eq(decode(encoded)['s'], s)
+
+
+@pytest.mark.parametrize('pd_format', ['arrow', 'lz4', 'zstd'])
+def test_encode_pd_arrow(pd_format):
+    values = [s, pd.Series([1,2], name = 3), df, 
+              pd.DataFrame([[1,2],[3,4]], drange(-1), columns = [0, dt(0)]),
+              pd.DataFrame(np.arange(6.).reshape(3,2), index = pd.MultiIndex.from_tuples([('a',1),('a',2),('b',1)], names = ['x','y']), columns = ['p','q']),
+              pd.DataFrame(np.arange(6.).reshape(3,2), columns = pd.MultiIndex.from_tuples([('a',1),('b',2)]))]
+    for value in values:
+        encoded = encode(value, pd_format = pd_format)
+        assert 'bson2pa' in encoded['_obj']
+        res = decode(encoded)
+        assert type(res) == type(value) and eq(res, value)
+        if isinstance(value, pd.Series):
+            assert res.name == value.name
+    res = decode(encode(pd.DataFrame(np.arange(6.).reshape(3,2), columns = ['p','q']), pd_format = pd_format))
+    res.iloc[0, 0] = 10. ## writable, as when decoded from pickle
+    assert res.iloc[0, 0] == 10.
+    mixed = pd.DataFrame(dict(a = [1, 'mixed', 2.0]))
+    assert eq(decode(encode(mixed, pd_format = pd_format)), mixed) ## falls back to pickle
+    with pytest.raises(ValueError):
+        encode(s, pd_format = 'gzip')
+    assert as_writer(pd_format)[0](dict(a = s))['a'] == encode(dict(a = s), pd_format = pd_format)['a']
+
+
+@pytest.fixture
+def payloads():
+    from pyg_encoders import inline_payloads
+    yield inline_payloads
+    inline_payloads(None, shuffle = True, spill_bytes = 0)
+
+
+@pytest.mark.parametrize('compression', ['lz4', 'zstd'])
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_inline_payloads_compression(payloads, compression, shuffle):
+    payloads(compression, shuffle = shuffle)
+    ts = np.repeat(np.arange(1000.), 10)
+    values = [ts, ts.reshape(100, 100), ts.astype('float32'), np.arange(1000), np.array(drange(-999), dtype = 'datetime64[ns]'), 
+              np.array(['a', 'b'] * 500), np.array([1, 'a', None] * 100, dtype = object), df, s]
+    for value in values:
+        encoded = encode(value)
+        res = decode(encoded)
+        assert eq(res, value)
+        if isinstance(value, np.ndarray) and value.dtype != np.dtype('O'):
+            assert res.dtype == value.dtype and res.shape == value.shape
+    encoded = encode(ts)
+    assert encoded['compression'] == compression and len(encoded['data']) < ts.nbytes / 5
+    assert ('shuffle' in encoded) == shuffle
+    random = np.random.bytes(1000)
+    assert 'compression' not in encode(np.frombuffer(random, np.uint8)) ## incompressible, so stored as is
+    with pytest.raises(ValueError):
+        payloads('zip')
+
+
+def test_inline_payloads_spill_over(payloads, tmp_path):
+    from pyg_encoders import flush
+    payloads('zstd', spill_bytes = 1000, spill_root = str(tmp_path))
+    big = np.random.normal(0, 1, 1000)
+    doc = encode(dict(big = big, small = np.arange(10.), frame = pd.DataFrame(np.random.normal(0,1,(100,3)))))
+    assert doc['big']['path'].startswith(str(tmp_path)) and 'data' in doc['small'] and 'path' in doc['frame']
+    assert encode(big)['path'] == doc['big']['path'] ## same payload, same file
+    flush()
+    res = decode(doc)
+    assert eq(res['big'], big) and eq(res['small'], np.arange(10.))
@@ -0,0 +1,155 @@
+from pyg_encoders._locks import LockTable
+import threading
+
+
+def test_lock_table_readers_do_not_block_each_other():
+    locks = LockTable(stripes = 1)
+    inside = threading.Barrier(2, timeout = 5)
+    def read():
+        with locks.read('a'):
+            inside.wait() ## both readers must be inside at the same time
+    threads = [threading.Thread(target = read) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not inside.broken
+
+
+def test_lock_table_writer_excludes_readers():
+    locks = LockTable(stripes = 16)
+    events = []
+    def read():
+        with locks.read('a'):
+            events.append('read')
+    with locks.write('a'):
+        t = threading.Thread(target = read)
+        t.start()
+        t.join(0.1)
+        assert events == []
+        with locks.write('a'): ## writer can re-enter
+            with locks.read('a'): ## and read
+                events.append('nested')
+    t.join(5)
+    assert events == ['nested', 'read']
+
+
+def test_lock_table_is_bounded():
+    locks = LockTable(stripes = 8)
+    for i in range(1000):
+        with locks['path%i'%i]:
+            pass
+    assert len(locks) == 8
+
+
+def _hold_lock(path, locked, release):
+    from pyg_encoders._locks import _LOCKS
+    with _LOCKS.write(path):
+        locked.set()
+        release.wait(10)
+
+
+def test_file_locking_across_processes(tmp_path):
+    import multiprocessing
+    import pytest
+    from pyg_encoders._locks import _LOCKS, file_locking
+    file_locking(True, timeout = 0.2)
+    try:
+        path = str(tmp_path / 'df.parquet')
+        locked = multiprocessing.Event(); release = multiprocessing.Event()
+        p = multiprocessing.Process(target = _hold_lock, args = (path, locked, release))
+        p.start()
+        assert locked.wait(10)
+        with pytest.raises(TimeoutError):
+            with _LOCKS.read(path):
+                pass
+        release.set()
+        p.join(10)
+        with _LOCKS.write(path):
+            with _LOCKS.read(path): ## re-entrant within the thread
+                pass
+    finally:
+        file_locking(False, timeout = 60)
+
+
+def test_atomic_writes_leave_no_temporary_files(tmp_path):
+    import os
+    import pandas as pd
+    from pyg_encoders._locks import _locked_to_parquet, _locked_read_parquet, _locked_to_pickle, _locked_read_pickle
+    df = pd.DataFrame(dict(a = [1,2,3]))
+    _locked_to_parquet(df, str(tmp_path / 'df.parquet'))
+    _locked_to_pickle(df, str(tmp_path / 'df.pickle'))
+    assert sorted(os.listdir(tmp_path)) == ['df.parquet', 'df.pickle']
+    assert _locked_read_parquet(str(tmp_path / 'df.parquet')).equals(df)
+    assert _locked_read_pickle(str(tmp_path / 'df.pickle')).equals(df)
+
+
+def test_atomic_write_failure_keeps_old_file(tmp_path):
+    import os
+    import pytest
+    import pandas as pd
+    from pyg_encoders._locks import _locked_to_parquet, _locked_read_parquet
+    path = str(tmp_path / 'df.parquet')
+    df = pd.DataFrame(dict(a = [1,2,3]))
+    _locked_to_parquet(df, path)
+    with pytest.raises(Exception):
+        _locked_to_parquet(pd.DataFrame(dict(a = [object()])), path)
+    assert os.listdir(tmp_path) == ['df.parquet']
+    assert _locked_read_parquet(path).equals(df)
+
+
+def test_atomic_writes_keep_compression_of_target(tmp_path):
+    import gzip
+    import pandas as pd
+    from pyg_encoders import pickle_dump, pickle_load
+    from pyg_encoders._locks import _locked_to_csv
+    df = pd.DataFrame(dict(a = [1,2,3]))
+    path = pickle_dump(df, str(tmp_path / 'df.pickle.gz'), max_workers = 0)
+    assert pickle_load(path).equals(df)
+    with gzip.open(path) as f: ## raises BadGzipFile if the temporary file was written uncompressed
+        f.read()
+    path = _locked_to_csv(df, str(tmp_path / 'df.csv.gz'), index = False)
+    assert pd.read_csv(path).equals(df)
+    with gzip.open(path) as f:
+        f.read()
+
+
+def test_writers_hold_a_single_stripe(tmp_path):
+    import threading
+    import pandas as pd
+    from pyg_base import Bi, dt, drange
+    from pyg_encoders import pd_to_parquet, pd_read_parquet
+    from pyg_encoders._locks import _LOCKS
+    path = str(tmp_path / 'df.parquet')
+    s = pd.Series([1.,2.,3.], drange(2))
+    pd_to_parquet(Bi(s, dt(0)), path, max_workers = 0)
+    pd_to_parquet(s, str(tmp_path / 'fp.parquet'), max_workers = 0, fingerprint = True)
+    mine = {id(_LOCKS._lock(path)), id(_LOCKS._lock(str(tmp_path / 'fp.parquet')))}
+    others = [lock for lock in _LOCKS._locks if id(lock) not in mine]
+    held = threading.Event(); done = threading.Event()
+    def hold(): ## another writer holding every other stripe
+        for lock in others:
+            lock.acquire_write()
+        held.set()
+        done.wait(10)
+        for lock in others:
+            lock.release_write()
+    holder = threading.Thread(target = hold); holder.start()
+    held.wait(10)
+    def write():
+        pd_to_parquet(Bi(s + 1, dt(1)), path, max_workers = 0, delta = True)
+        pd_to_parquet(s + 1, path, max_workers = 0, append = True)
+        pd_to_parquet(s + 1, str(tmp_path / 'fp.parquet'), max_workers = 0, fingerprint = True)
+        pd_read_parquet(path)
+    writer = threading.Thread(target = write); writer.start()
+    writer.join(10)
+    blocked = writer.is_alive()
+    done.set(); holder.join(); writer.join()
+    assert not blocked
+
+
+def test_locked_np_save(tmp_path):
+    import numpy as np
+    from pyg_encoders._locks import _locked_np_save, _locked_np_load
+    path = _locked_np_save(np.arange(3.), str(tmp_path / 'a.npy'))
+    assert (_locked_np_load(path) == np.arange(3.)).all()
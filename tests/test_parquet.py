@@ -0,0 +1,104 @@
+from pyg_base import eq, dt, drange, Bi, dictable
+from pyg_encoders import pd_to_parquet, pd_read_parquet, pd_iter_parquet, compact, dictable_to_parquet, dictable_read_parquet, parquet_encode, decode
+import pandas as pd
+import numpy as np
+import os
+import pytest
+
+
+def test_bitemporal_deltas(tmp_path):
+    path = str(tmp_path / 'bi.parquet')
+    history = pd.DataFrame(np.random.normal(0,1,(20,3)), drange(-19), columns = ['a', 'b', 'c'])
+    pd_to_parquet(history, path, asof = dt(2000,1,1), max_workers = 0)
+    today = history.iloc[-1:] + 1
+    pd_to_parquet(today, path, asof = dt(2001,1,1), max_workers = 0, delta = True)
+    assert len(os.listdir(path + '.deltas')) == 1
+    assert eq(pd_read_parquet(path, asof = dt(2000,6,1)), history)
+    assert eq(pd_read_parquet(path, asof = dt(2001,6,1)).iloc[-1], today.iloc[-1])
+    before = pd_read_parquet(path, asof = dt(1999,1,1)) ## earlier than all the data
+    assert len(before) == 0 and list(before.columns) == ['a', 'b', 'c'] and before.dtypes.tolist() == history.dtypes.tolist()
+    merged = pd_read_parquet(path)
+    compact(path)
+    assert not os.path.exists(path + '.deltas')
+    assert eq(pd_read_parquet(path), merged)
+
+
+def test_full_write_supersedes_deltas(tmp_path):
+    path = str(tmp_path / 'bi.parquet')
+    s = pd.Series([1.,2.,3.], drange(2))
+    pd_to_parquet(s, path, asof = dt(2000,1,1), max_workers = 0)
+    pd_to_parquet(s + 1, path, asof = dt(2001,1,1), max_workers = 0, delta = True)
+    pd_to_parquet(s * 10, path, max_workers = 0)
+    assert not os.path.exists(path + '.deltas')
+    assert eq(pd_read_parquet(path), s * 10)
+
+
+def test_pd_read_parquet_pushdown(tmp_path):
+    value = pd.DataFrame(np.random.normal(0,1,(100,4)), drange(-99), columns = ['a', 'b', 'c', 'd'])
+    path = pd_to_parquet(value, str(tmp_path / 'df.parquet'), max_workers = 0)
+    assert eq(pd_read_parquet(path, columns = ['a', 'b'], start = dt(-9)), value[['a', 'b']].loc[dt(-9):])
+    assert eq(pd_read_parquet(path, end = dt(-90)), value.loc[:dt(-90)])
+    start = str(value.index[-10].date()) ## e.g. '2020-01-01'
+    assert eq(pd_read_parquet(path, columns = ['a'], start = start), value[['a']].loc[start:])
+    from pyg_encoders._parquet import _read_parquet_file
+    assert eq(_read_parquet_file(path, start = object()), value) ## pyarrow cannot apply the filter so we read the whole file rather than None
+    bi = pd_to_parquet(value, str(tmp_path / 'bi.parquet'), asof = dt(2000,1,1), max_workers = 0)
+    pd_to_parquet(value + 1, bi, asof = dt(2001,1,1), max_workers = 0)
+    assert eq(pd_read_parquet(bi, asof = dt(2000,6,1), columns = 'c', start = dt(-9)), value[['c']].loc[dt(-9):])
+    assert eq(pd_read_parquet(bi, asof = dt(2001,6,1), columns = 'c', start = dt(-9)), value[['c']].loc[dt(-9):] + 1)
+
+
+def test_pd_to_parquet_streams_chunks(tmp_path):
+    import pyarrow.parquet as pq
+    value = pd.DataFrame(np.random.normal(0,1,(1000,3)), drange(-999), columns = [0, 'b', dt(0)])
+    path = pd_to_parquet(value, str(tmp_path / 'df.parquet'), chunk_size = 100, max_workers = 0)
+    assert pq.ParquetFile(path).metadata.num_row_groups == 10
+    assert eq(pd_read_parquet(path), value)
+    chunks = list(pd_iter_parquet(path, chunk_size = 300))
+    assert [len(chunk) for chunk in chunks] == [300, 300, 300, 100]
+    assert eq(pd.concat(chunks), value)
+    assert list(pd_iter_parquet(path, columns = ['b']))[0].columns.tolist() == ['b']
+
+    def days():
+        for i in range(5):
+            yield value.iloc[i * 200 : (i + 1) * 200]['b']
+    path = pd_to_parquet(days(), str(tmp_path / 's.parquet'), max_workers = 0)
+    assert eq(pd_read_parquet(path), value['b'].rename(None))
+    assert eq(pd.concat(pd_iter_parquet(path)), value['b'].rename(None))
+    with pytest.raises(ValueError):
+        pd_to_parquet(iter([]), str(tmp_path / 'empty.parquet'), max_workers = 0)
+    assert not os.path.exists(str(tmp_path / 'empty.parquet'))
+
+
+def test_pd_to_parquet_append(tmp_path):
+    value = pd.DataFrame(np.random.normal(0,1,(100,3)), drange(-99), columns = [0, 'b', dt(0)])
+    path = pd_to_parquet(value.iloc[:50], str(tmp_path / 'df.parquet'), max_workers = 0, append = True)
+    pd_to_parquet(value.iloc[50:80] + 1, path, max_workers = 0, append = True)
+    pd_to_parquet(value.iloc[50:], path, max_workers = 0, append = True) ## overlaps the previous part, last write wins
+    assert len(os.listdir(path + '.parts')) == 2
+    assert eq(pd_read_parquet(path), value)
+    assert eq(pd_read_parquet(path, columns = 'b', start = dt(-9)), value[['b']].loc[dt(-9):])
+    compact(path)
+    assert not os.path.exists(path + '.parts')
+    assert eq(pd_read_parquet(path), value)
+    pd_to_parquet(value.iloc[:10], path, max_workers = 0, append = True)
+    pd_to_parquet(value, path, max_workers = 0) ## a full write supersedes the parts
+    assert not os.path.exists(path + '.parts')
+    assert eq(pd_read_parquet(path), value)
+
+
+def test_dictable_to_parquet(tmp_path):
+    data = [pd.DataFrame(np.random.normal(0,1,(10,2)), drange(-9), columns = [0, 'b']) for _ in range(6)]
+    rs = dictable(country = ['uk', 'us', 'fr'] * 2, city = list(range(6)), data = data, s = [d['b'] for d in data[:5]] + [None])
+    path = dictable_to_parquet(rs, str(tmp_path / 'rs.dictable'), partition_cols = 'country', max_workers = 0)
+    assert sorted(os.listdir(os.path.join(path, 'data'))) == ['country=fr', 'country=uk', 'country=us']
+    res = dictable_read_parquet(path)
+    assert res.city == rs.city and res.country == rs.country
+    assert all([eq(a, b) for a, b in zip(res.data, data)])
+    assert all([eq(a, b['b'].rename(None)) for a, b in zip(res.s[:5], data)]) and res.s[5] is None
+    uk = dictable_read_parquet(path, filters = dict(country = 'uk'), columns = 'data')
+    assert uk.city == [0, 3] and eq(uk[1].data, data[3])
+    assert dictable_read_parquet(path, filters = dict(city = [1, 2])).city == [1, 2]
+    encoded = parquet_encode(dict(rs = rs), str(tmp_path / 'doc'), partition_cols = True, max_workers = 0)
+    assert eq(decode(encoded)['rs'].data[4], data[4])
+    assert [f for f in os.listdir(encoded['rs']['path'] + '/data') if '=' in f] == [] ## no partitioning unless we ask for it
@@ -0,0 +1,137 @@
+from pyg_base import eq, drange
+from pyg_encoders import executor_pool, pd_to_parquet, pd_read_parquet, pickle_dump, pickle_load, submit_write, pending, flush, write_barrier, write_stats, WriteError
+from pyg_encoders._encoders import _pd_to_npy
+from pyg_npy import pd_read_npy
+import pandas as pd
+import numpy as np
+import pytest
+import threading
+import time
+
+
+def test_flush_waits_for_writes(tmp_path):
+    values = [pd.Series(np.random.normal(0,1,100), drange(-99)) for _ in range(10)]
+    paths = [pd_to_parquet(v, str(tmp_path / ('%i.parquet'%i))) for i, v in enumerate(values)]
+    flush()
+    assert len(pending()) == 0
+    for v, path in zip(values, paths):
+        assert eq(pd_read_parquet(path), v)
+
+
+def _fail(path):
+    time.sleep(0.01)
+    raise ValueError('cannot write %s'%path)
+
+
+def test_flush_reraises_write_errors(tmp_path):
+    path = str(tmp_path / 'fail.parquet')
+    submit_write(_fail, path, path = path, pool_name = 'test_threads')
+    with pytest.raises(WriteError) as e:
+        flush('test_threads')
+    assert path in e.value.errors
+    assert flush('test_threads') == [] ## errors are only raised once
+
+
+def test_write_barrier(tmp_path):
+    path = str(tmp_path / 'df.pickle')
+    df = pd.DataFrame(dict(a = [1,2,3]))
+    with write_barrier():
+        pickle_dump(df, path)
+    assert pending() == {}
+    assert eq(pickle_load(path), df)
+    with pytest.raises(WriteError):
+        with write_barrier('test_threads'):
+            submit_write(_fail, path, path = path, pool_name = 'test_threads')
+
+
+def test_coalesce_drops_superseded_writes(tmp_path):
+    event = threading.Event()
+    pool = 'test_coalesce'
+    blocker = submit_write(event.wait, path = 'blocker', max_workers = 1, pool_name = pool)
+    path = str(tmp_path / 'df.parquet')
+    before = write_stats(pool)
+    for i in range(5):
+        pd_to_parquet(pd.DataFrame(dict(a = [i])), path, max_workers = 1, pool_name = pool)
+    event.set()
+    flush(pool)
+    stats = write_stats(pool)
+    assert stats['dropped'] - before['dropped'] == 4
+    assert eq(pd_read_parquet(path), pd.DataFrame(dict(a = [4])))
+
+
+def test_append_writes_are_not_coalesced(tmp_path):
+    event = threading.Event()
+    pool = 'test_append'
+    submit_write(event.wait, path = 'blocker', max_workers = 1, pool_name = pool)
+    path = str(tmp_path / 'ts.npy')
+    before = write_stats(pool)
+    for i in range(3):
+        _pd_to_npy(pd.Series([float(i)], [i]), path, mode = 'a', max_workers = 1, pool_name = pool)
+    event.set()
+    flush(pool)
+    assert write_stats(pool)['dropped'] == before['dropped']
+    assert list(pd_read_npy(path).values) == [0., 1., 2.]
+
+
+def test_bounded_pool_writes_synchronously_when_full(tmp_path):
+    event = threading.Event()
+    pool = 'test_bounded'
+    executor_pool(1, pool, max_pending = 2, when_full = 'sync')
+    submit_write(event.wait, path = 'blocker', max_workers = 1, pool_name = pool)
+    try:
+        paths = [pd_to_parquet(pd.DataFrame(dict(a = [i])), str(tmp_path / ('%i.parquet'%i)), max_workers = 1, pool_name = pool) for i in range(4)]
+        stats = write_stats(pool)
+        assert stats['high_water'] == 2
+        assert stats['sync'] == 3 ## the blocker and one write are in flight, the rest are written immediately
+        assert eq(pd_read_parquet(paths[-1]), pd.DataFrame(dict(a = [3])))
+    finally:
+        event.set()
+    flush(pool)
+    assert write_stats(pool)['queued'] == 0
+
+
+def test_process_pool(tmp_path):
+    pool = 'test_process'
+    executor_pool(2, pool, kind = 'process')
+    df = pd.DataFrame(np.random.normal(0,1,(100,3)), drange(-99), columns = ['a', 'b', 'c'])
+    s = pd.Series(np.random.normal(0,1,100), drange(-99))
+    df_path = str(tmp_path / 'df.parquet')
+    for i in range(5):
+        pd_to_parquet(df + i, df_path, max_workers = 2, pool_name = pool)
+    s_path = pickle_dump(s, str(tmp_path / 's.pickle'), max_workers = 2, pool_name = pool)
+    flush(pool)
+    assert eq(pd_read_parquet(df_path), df + 4)
+    assert eq(pickle_load(s_path), s)
+    with pytest.raises(ValueError):
+        executor_pool(2, pool, kind = 'thread')
+
+
+def test_appends_to_a_path_are_applied_in_order(tmp_path):
+    pool = 'test_append_order'
+    path = str(tmp_path / 'ts.npy')
+    for i in range(200):
+        _pd_to_npy(pd.Series([float(i)], [i]), path, mode = 'a', max_workers = 4, pool_name = pool)
+    flush(pool)
+    assert list(pd_read_npy(path).values) == [float(i) for i in range(200)]
+
+
+def test_sync_writes_do_not_overtake_queued_appends(tmp_path):
+    pool = 'test_sync_append_order'
+    executor_pool(1, pool, max_pending = 2, when_full = 'sync')
+    path = str(tmp_path / 'ts.npy')
+    for i in range(20):
+        _pd_to_npy(pd.Series([float(i)], [i]), path, mode = 'a', max_workers = 1, pool_name = pool)
+    flush(pool)
+    assert list(pd_read_npy(path).values) == [float(i) for i in range(20)]
+
+
+def test_process_pool_pickles_non_parquet_writes(tmp_path):
+    pool = 'test_process_pickle'
+    executor_pool(2, pool, kind = 'process')
+    df = pd.DataFrame(dict(a = pd.Series([1, None, 3], dtype = object).values, b = [1., 2., 3.]), index = pd.date_range('2020-01-01', periods = 3, freq = 'D'))
+    path = pickle_dump(df, str(tmp_path / 'df.pickle'), max_workers = 2, pool_name = pool)
+    flush(pool)
+    res = pickle_load(path)
+    assert res['a'].dtype == object and list(res['a']) == [1, None, 3]
+    assert res.index.freq == df.index.freq
+    assert eq(res, df)